@@ -1,4 +1,4 @@
-from flask import Flask, request, abort # type: ignore
+from flask import Flask, request, abort, jsonify # type: ignore
 from linebot.models import TextMessage, AudioMessage, ImageMessage # type: ignore
 from linebot import LineBotApi, WebhookHandler # type: ignore
 from linebot.exceptions import InvalidSignatureError # type: ignore
@@ -6,14 +6,21 @@ from linebot.models import *
 # ======自訂的函數庫==========
 from message_response import MessageResponse
 from config import Config
-from utils.extract_data import pg_extract
+from utils.article_cache import ArticleCache
+from utils.crawl_coalescer import FRESH
+from utils.crawl_notifier import CrawlNotifier
 from utils.logger import setup_logger
-from worker.celery_worker import fetch_stock_news, celery
+from utils.event_dispatcher import QueuedWebhookHandler, QueueFullError
+from utils.line_messages import error_response, follow_up_messages, push_target
+from utils.session_store import SessionStore
+from worker.celery_worker import fetch_stock_news, celery, crawl_coalescer
+from worker.llm_tasks import analyze_image, answer_chat, transcribe_audio
 # ======自訂的函數庫==========
 
 
 # ======python的函數庫==========
 import tempfile, os
+import base64
 import boto3 # type: ignore
 import json
 import traceback
@@ -28,7 +35,14 @@ static_tmp_path = os.path.join(os.path.dirname(__file__), "static", "tmp")
 # Channel Access Token
 line_bot_api = LineBotApi(Config.CHANNEL_ACCESS_TOKEN)
 # Channel Secret
-handler = WebhookHandler(Config.CHANNEL_SECRET)
+if Config.DISPATCH_MODE == "inline":
+    handler = WebhookHandler(Config.CHANNEL_SECRET)
+else:
+    handler = QueuedWebhookHandler(
+        Config.CHANNEL_SECRET,
+        workers=Config.DISPATCH_WORKERS,
+        max_queue_size=Config.DISPATCH_QUEUE_SIZE,
+    )
 
 # Initialize the Message_Response class and ScrapyRunner class
 msg_response = MessageResponse()
@@ -47,16 +61,22 @@ s3 = boto3.client(
 )
 S3_BUCKET = Config.S3_BUCKET
 
-# global variable to store the questions
-last_questions = []
-current_method = ""
+# Cached article lookups, invalidated by the crawler's pipeline
+article_cache = ArticleCache(Config.REDIS_URL, ttl=Config.ARTICLE_CACHE_TTL)
+
+# Users waiting on a background crawl, notified by the Celery task when it ends
+crawl_notifier = CrawlNotifier(Config.REDIS_URL, line_bot_api, ttl=Config.CRAWL_LOCK_TTL)
+
+# Per-user state: current mode and the last follow-up questions
+sessions = SessionStore(
+    redis_url=Config.REDIS_URL,
+    maxsize=Config.SESSION_MAX_USERS,
+    ttl=Config.SESSION_TTL,
+    local_ttl=Config.SESSION_LOCAL_TTL,
+)
 chat_method = "@chat"
 stock_method = "@stock"
 
-# regular response
-question_response = "選擇一個問題編號來獲取更多信息"
-error_response = "處理您的請求時發生錯誤，請稍後再試。"
-
 
 # 監聽所有來自 /callback 的 Post Request
 @app.route("/callback", methods=["POST"])
@@ -74,47 +94,80 @@ def callback():
             "Invalid signature. Please check your channel access token/channel secret."
         )
         abort(400)
+    except QueueFullError as e:
+        # Let LINE redeliver the webhook once the workers catch up
+        logger.warning(e)
+        abort(503)
     return "OK"
 
 
-def create_quick_reply_buttons(questions):
-    buttons = []
-    logger.info(questions)
-    for index, question in enumerate(
-        questions[:10], start=1
-    ):  # Limit to first 10 questions
-        label = f"{index}"
-        buttons.append(
-            QuickReplyButton(action=MessageAction(label=label, text=str(index))) # type: ignore
-        )
-    return buttons
+@app.route("/dispatcher", methods=["GET"])
+def dispatcher_status():
+    if isinstance(handler, QueuedWebhookHandler):
+        return jsonify(handler.status())
+    return jsonify({"mode": "inline"})
+
+
+@app.route("/intent-router", methods=["GET"])
+def intent_router_status():
+    return jsonify(msg_response.intent_router.stats())
+
+
+@app.route("/llm-cache", methods=["GET"])
+def llm_cache_status():
+    return jsonify(msg_response.llm_cache.stats())
+
+
+@app.route("/crawls", methods=["GET"])
+def crawl_status():
+    return jsonify(crawl_coalescer.stats())
 
 
 def send_perplexity_response(event, answer, questions=None): 
     """Helper function to send formatted Perplexity responses"""
-    global last_questions
-    
-    if not questions:
-        messages = [
-            TextSendMessage(text=answer), # type: ignore
-            TextSendMessage(text="請提供更詳細的問題"), # type: ignore
-        ]
-    else:
-        last_questions = questions.split("\n")
-        quick_reply_buttons = create_quick_reply_buttons(last_questions)
-        messages = [
-            TextSendMessage(text=answer), # type: ignore
-            TextSendMessage(text=f"以下是後續問題：\n{questions}"), # type: ignore
-            TextSendMessage( # type: ignore
-                text=question_response, 
-                quick_reply=QuickReply(items=quick_reply_buttons), # type: ignore
-            ),
-        ]
-    
+    messages = [TextSendMessage(text=answer)] + follow_up_messages(sessions, event.source.user_id, questions) # type: ignore
     line_bot_api.reply_message(event.reply_token, messages)
 
+def handle_streaming_request(event, msg, rephrase=True):
+    """Send the Perplexity answer chunk by chunk while it is being generated"""
+    replied = False
+
+    def send(messages):
+        nonlocal replied
+        # The reply token can only be used once, everything after it is pushed
+        if replied:
+            line_bot_api.push_message(push_target(event), messages)
+        else:
+            line_bot_api.reply_message(event.reply_token, messages)
+            replied = True
+
+    try:
+        chunks, further_future = msg_response.stream_response(
+            user_id=event.source.user_id,
+            msg=msg,
+            rephrase=rephrase,
+        )
+        for chunk in chunks:
+            send(TextSendMessage(text=chunk)) # type: ignore
+        try:
+            questions = further_future.result(timeout=Config.FURTHER_TIMEOUT)
+        except Exception as e:
+            logger.error(f"Follow-up questions failed: {e}")
+            questions = None
+        send(follow_up_messages(sessions, event.source.user_id, questions))
+    except Exception as e:
+        logger.exception(traceback.format_exc())
+        logger.error(e)
+        send(TextSendMessage(error_response)) # type: ignore
+
 def handle_perplexity_request(event, msg, rephrase=True):
     """Helper function to handle Perplexity API calls with error handling"""
+    if Config.LLM_OFFLOAD:
+        # Answered on the chat queue and pushed, the reply token goes unused
+        answer_chat.delay(push_target(event), event.source.user_id, msg, rephrase)
+        return
+    if Config.STREAM_RESPONSES:
+        return handle_streaming_request(event, msg, rephrase)
     try:
         answer, questions = msg_response.Perplexity_response(
             user_id=event.source.user_id,
@@ -133,13 +186,13 @@ def handle_perplexity_request(event, msg, rephrase=True):
 # 處理文本訊息
 @handler.add(MessageEvent, message=TextMessage) # type: ignore
 def handle_text_message(event):
-    global current_method
     msg = event.message.text
+    user_id = event.source.user_id
 
     # Handle clear command
     if msg == "@clear":
         try:
-            msg_response.clear_memory()
+            msg_response.clear_memory(event.source.user_id)
             line_bot_api.reply_message(event.reply_token, TextSendMessage("已刪除歷史紀錄")) # type: ignore
             logger.info("成功刪除")
         except Exception as e:
@@ -149,112 +202,93 @@ def handle_text_message(event):
 
     # Handle mode switching commands
     if msg == stock_method:
-        current_method = stock_method
+        sessions.update(user_id, current_method=stock_method)
         line_bot_api.reply_message(event.reply_token, TextSendMessage("股票模式開啟, 請輸入股票代碼或名字")) # type: ignore
         return
     elif msg == chat_method or msg == "@exit":
-        current_method = chat_method
+        sessions.update(user_id, current_method=chat_method)
         line_bot_api.reply_message(event.reply_token, TextSendMessage("Exiting stock mode.")) # type: ignore
         return
 
     # Handle messages based on current mode
-    if current_method == stock_method:
+    if sessions.get_field(user_id, "current_method") == stock_method:
         handle_stock_message(event)
     else:
         handle_chat_message(event)
 
 def handle_chat_message(event):
-    global last_questions
     msg = event.message.text
     user_id = event.source.user_id
 
     # Check if there's a stored image for this user
     temp_image_path = msg_response.get_temp_image(user_id)
-    if temp_image_path:
+    if temp_image_path and Config.LLM_OFFLOAD:
+        try:
+            with open(temp_image_path, "rb") as image_file:
+                image_base64 = base64.b64encode(image_file.read()).decode("utf-8")
+            msg_response.clear_temp_image(user_id)
+            analyze_image.delay(
+                push_target(event), user_id, image_base64, msg, msg_response.s3_urls.pop(user_id, None)
+            )
+        except Exception as e:
+            logger.exception(f"Error processing image with info: {e}")
+            line_bot_api.reply_message(
+                event.reply_token, TextSendMessage(error_response) # type: ignore
+            )
+    elif temp_image_path:
         try:
             # Process the image with the additional information
-            response = msg_response.process_image_with_info(temp_image_path, msg)
+            response = msg_response.process_image_with_info(user_id, temp_image_path, msg)
 
             # Clear the stored image path
             msg_response.clear_temp_image(user_id)
 
-            _, questions = msg_response.Perplexity_response(
+            answer, questions = msg_response.Perplexity_response(
                 user_id=user_id,
                 msg=f"Provide more information from this object describe:{response}",
             )
-
-            # Split the questions and filter out any empty strings
-            last_questions = questions.split("\n")
-
-            quick_reply_buttons = create_quick_reply_buttons(last_questions)
-
-            messages = [
-                TextSendMessage(text=_), # type: ignore
-                TextSendMessage(text=f"以下是後續問題：\n{questions}"), # type: ignore
-                TextSendMessage( # type: ignore
-                    text=question_response,
-                    quick_reply=QuickReply(items=quick_reply_buttons), # type: ignore
-                ),
-            ]
-            line_bot_api.reply_message(event.reply_token, messages)
+            send_perplexity_response(event, answer, questions)
         except Exception as e:
             logger.exception(f"Error processing image with info: {e}")
             line_bot_api.reply_message(
                 event.reply_token, TextSendMessage(error_response) # type: ignore
             )
     else:
+        last_questions = sessions.get_field(user_id, "last_questions", [])
         if msg.isdigit() and 1 <= int(msg) <= len(last_questions):
             question_index = int(msg) - 1
             select_question = last_questions[question_index]
             handle_perplexity_request(event, select_question, rephrase=False)
         else:
-            try:
-                _, questions = msg_response.Perplexity_response(
-                    user_id=user_id,
-                    msg=msg,
-                )
-                if questions:
-                    last_questions = questions.split("\n")
-                    quick_reply_buttons = create_quick_reply_buttons(last_questions)
-
-                    messages = [
-                        TextSendMessage(text=_), # type: ignore
-                        TextSendMessage(text=f"以下是後續問題：\n{questions}"), # type: ignore
-                        TextSendMessage( # type: ignore
-                            text=question_response,
-                            quick_reply=QuickReply(items=quick_reply_buttons), # type: ignore
-                        ),
-                    ]
-                    line_bot_api.reply_message(event.reply_token, messages)
-                else:
-                    messages = [
-                        TextSendMessage(text=_), # type: ignore
-                        TextSendMessage(text="請提供更詳細的問題"), # type: ignore
-                    ]
-                    line_bot_api.reply_message(event.reply_token, messages)
-            except Exception as e:
-                logger.exception(traceback.format_exc())
-                logger.error(e)
-                line_bot_api.reply_message(
-                    event.reply_token, TextSendMessage(error_response) # type: ignore
-                )
+            # Only rephrased when the intent router is confident it leans on the history
+            handle_perplexity_request(event, msg, rephrase=True)
 
 def handle_stock_message(event):
-    global current_method
     msg = event.message.text
 
     try:
         stock_id = int(msg)
+        target = push_target(event)
+        # Registered before requesting, so a crawl that ends right away still finds the user
+        waiting = crawl_notifier.add_waiter(stock_id, target)
+        status = None
         try:
-            # Run the Scrapy crawler with the stock ID
-            fetch_stock_news.delay(stock_id)
+            # Run the Scrapy crawler with the stock ID, unless it is fresh or already running
+            status, task_id = crawl_coalescer.request(
+                stock_id,
+                lambda task_id: fetch_stock_news.apply_async(args=[stock_id], task_id=task_id),
+            )
+            logger.info(f"Crawl of {stock_id}: {status} ({task_id})")
         except Exception as e:
             logger.error(f"Failed to trigger Celery task: {e}")
             # Log the error but continue
-        print('================================================================')
-        # line_bot_api.reply_message(event.reply_token, TextSendMessage(f"Handling stock id: {stock_id}"))
-        article_list = pg_extract(stock_id=stock_id)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(f"Extracting the number of articles: {len(article_list)}")) # type: ignore
+        if waiting and status is not None and status != FRESH:
+            # The task pushes the new articles when the crawl is done
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(f"正在更新 {stock_id} 的最新新聞，完成後會通知您。")) # type: ignore
+        else:
+            crawl_notifier.remove_waiter(stock_id, target)
+            article_count = article_cache.count(stock_id)
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(f"Extracting the number of articles: {article_count}")) # type: ignore
         # Reply the stock information to LLM
     except ValueError:
         try:
@@ -276,6 +310,11 @@ def handle_audio_message(event):
         logger.error("No audio content found.")
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text="無法獲取音訊內容。")) # type: ignore
         return
+    if Config.LLM_OFFLOAD:
+        # Transcribed on the media queue, then answered on the chat queue
+        audio_base64 = base64.b64encode(b"".join(audio_content.iter_content())).decode("utf-8")
+        transcribe_audio.delay(push_target(event), event.source.user_id, audio_base64)
+        return
     try:
         with tempfile.NamedTemporaryFile(delete=False, suffix=".m4a") as tf:
             for chunk in audio_content.iter_content():
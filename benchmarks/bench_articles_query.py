@@ -0,0 +1,71 @@
+"""
+Check that the hot per-stock articles queries use the (stock_id, date DESC) index
+and time them. Needs the database settings, run from the repo root:
+
+    python -m benchmarks.bench_articles_query [stock_id] [rounds]
+
+Exits with status 1 when a plan still scans the whole articles table.
+"""
+import json
+import sys
+import time
+from statistics import mean, median
+
+from utils.db import connection
+
+QUERIES = {
+    "count": """
+        SELECT COUNT(*) FROM articles
+        WHERE stock_id = %s AND date >= NOW() - make_interval(days => 30)
+    """,
+    "list": """
+        SELECT id, title, url, date FROM articles
+        WHERE stock_id = %s AND date >= NOW() - make_interval(days => 30)
+        ORDER BY date DESC
+    """,
+}
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def explain(cur, sql, stock_id) -> dict:
+    cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, (stock_id,))
+    plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]
+
+
+if __name__ == "__main__":
+    stock_id = int(sys.argv[1]) if len(sys.argv) > 1 else 2330
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    ok = True
+    with connection() as conn:
+        with conn.cursor() as cur:
+            for name, sql in QUERIES.items():
+                result = explain(cur, sql, stock_id)
+                nodes = list(plan_nodes(result["Plan"]))
+                seq_scans = [
+                    n for n in nodes
+                    if n["Node Type"] == "Seq Scan" and n.get("Relation Name", "").startswith("articles")
+                ]
+                indexes = sorted({n["Index Name"] for n in nodes if "Index Name" in n})
+                if seq_scans:
+                    ok = False
+
+                timings = []
+                for _ in range(rounds):
+                    start = time.perf_counter()
+                    cur.execute(sql, (stock_id,))
+                    cur.fetchall()
+                    timings.append((time.perf_counter() - start) * 1000)
+                print(
+                    f"{name:<6} indexes={indexes or '-'} seq_scans={len(seq_scans)} "
+                    f"plan={result['Plan']['Node Type']} execution={result['Execution Time']:.2f}ms "
+                    f"client mean={mean(timings):.2f}ms median={median(timings):.2f}ms"
+                )
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,101 @@
+"""
+Compare the three-call chat path (rephrase + Perplexity answer + follow-up questions)
+with SINGLE_CALL_MODE, where one Perplexity call returns the answer and the follow-ups.
+Needs the real API keys, run from the repo root:
+
+    python -m benchmarks.bench_single_call [rounds]
+"""
+import sys
+import time
+import uuid
+from statistics import mean, median
+
+from langchain_core.callbacks import BaseCallbackHandler # type: ignore
+
+from config import Config
+from message_response import MessageResponse
+
+QUESTIONS = [
+    "台積電今天為什麼跌?",
+    "聯發科最近的營收表現如何?",
+    "美國升息對台股有什麼影響?",
+    "長榮海運的股利政策是什麼?",
+]
+
+
+class TokenUsageHandler(BaseCallbackHandler):
+    """Sum the prompt/completion tokens reported by every LLM call."""
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def reset(self) -> None:
+        self.calls = self.prompt_tokens = self.completion_tokens = 0
+
+    def on_llm_end(self, response, **kwargs) -> None:
+        self.calls += 1
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if not usage:
+            for generations in response.generations:
+                for generation in generations:
+                    metadata = getattr(generation.message, "usage_metadata", None) or {}
+                    usage = {
+                        "prompt_tokens": metadata.get("input_tokens", 0),
+                        "completion_tokens": metadata.get("output_tokens", 0),
+                    }
+        self.prompt_tokens += usage.get("prompt_tokens", 0)
+        self.completion_tokens += usage.get("completion_tokens", 0)
+
+
+def run(msg_response, usage, single_call, rounds) -> list:
+    Config.SINGLE_CALL_MODE = single_call
+    results = []
+    for _ in range(rounds):
+        for question in QUESTIONS:
+            usage.reset()
+            # A fresh user per question so both modes see the same empty history
+            user_id = f"bench-{uuid.uuid4()}"
+            start = time.perf_counter()
+            answer, questions = msg_response.Perplexity_response(
+                user_id=user_id, msg=question, rephrase=True
+            )
+            elapsed = time.perf_counter() - start
+            msg_response.clear_memory(user_id)
+            results.append(
+                (elapsed, usage.calls, usage.prompt_tokens, usage.completion_tokens, answer != "Error")
+            )
+    return results
+
+
+def report(name, results) -> None:
+    latencies = [r[0] for r in results]
+    print(
+        f"{name:<12} n={len(results)} "
+        f"latency mean={mean(latencies):.2f}s median={median(latencies):.2f}s max={max(latencies):.2f}s "
+        f"llm calls={mean(r[1] for r in results):.1f} "
+        f"prompt tokens={mean(r[2] for r in results):.0f} "
+        f"completion tokens={mean(r[3] for r in results):.0f} "
+        f"ok={sum(r[4] for r in results)}/{len(results)}"
+    )
+
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    msg_response = MessageResponse()
+    # Chat history goes to Postgres, not wanted for a benchmark
+    msg_response.save_chat_history = lambda *args, **kwargs: None
+    # Measure the calls themselves: always rephrase (fresh users have no history, the
+    # router would skip it) and never answer from the caches, which the repeated
+    # questions of later rounds would hit
+    msg_response.intent_router.needs_rephrase = lambda msg, history: True
+    msg_response.llm_cache.get = lambda key: None
+    msg_response.semantic_cache = None
+
+    usage = TokenUsageHandler()
+    for llm, _, _ in msg_response.chain_specs.values():
+        llm.callbacks = [usage]
+
+    report("three-call", run(msg_response, usage, False, rounds))
+    report("single-call", run(msg_response, usage, True, rounds))
@@ -1,7 +1,42 @@
 # celery_config.py
 from celery import Celery
+from celery.signals import celeryd_init
+from kombu import Queue
 import os
 
+# Queues in priority order: a worker consuming several of them drains the first
+# non-empty one first, so interactive chat always goes ahead of crawls
+QUEUES = ("chat", "media", "crawl")
+
+# Worker processes per queue. A worker started for some queues with -Q (see the
+# Procfile) runs the sum of their concurrency unless -c is given; without -Q the
+# worker consumes every queue with Celery's default concurrency
+QUEUE_CONCURRENCY = {
+    "chat": int(os.getenv("CHAT_CONCURRENCY", 8)),
+    "media": int(os.getenv("MEDIA_CONCURRENCY", 4)),
+    "crawl": int(os.getenv("CRAWL_CONCURRENCY", 2)),
+}
+
+TASK_ROUTES = {
+    'worker.llm_tasks.answer_chat': {'queue': 'chat'},
+    'worker.llm_tasks.analyze_image': {'queue': 'media'},
+    'worker.llm_tasks.transcribe_audio': {'queue': 'media'},
+    'worker.celery_worker.*': {'queue': 'crawl'},
+}
+
+def queue_concurrency(queues):
+    return sum(QUEUE_CONCURRENCY[name] for name in queues if name in QUEUE_CONCURRENCY)
+
+def configure_worker(sender=None, conf=None, options=None, **kwargs):
+    """Size a worker from the queues it consumes, runs before the pool is created."""
+    options = options or {}
+    queues = options.get("queues") or []
+    if isinstance(queues, str):
+        queues = queues.split(",")
+    queues = [name.strip() for name in queues]
+    if queues and not options.get("concurrency") and queue_concurrency(queues):
+        conf.worker_concurrency = queue_concurrency(queues)
+
 def make_celery(broker_url, backend_url):
     celery = Celery(
         'celery_worker',          # Name of the Celery app
@@ -16,5 +51,13 @@ def make_celery(broker_url, backend_url):
         'accept_content': ['json'],
         'timezone': 'UTC',
         'enable_utc': True,
+        'task_queues': [Queue(name, routing_key=name) for name in QUEUES],
+        'task_default_queue': 'crawl',
+        'task_routes': TASK_ROUTES,
+        # The Redis transport checks the queues in the order above
+        'broker_transport_options': {'queue_order_strategy': 'priority'},
+        # LLM calls take seconds, don't let one process hoard queued chat tasks
+        'worker_prefetch_multiplier': 1,
     })
-    return celery
\ No newline at end of file
+    celeryd_init.connect(configure_worker)
+    return celery
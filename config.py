@@ -19,10 +19,78 @@ class Config:
     DB_NAME = os.getenv("DB_NAME")
     DB_USER = os.getenv("DB_USER")
     DB_PASSWORD = os.getenv("DB_PASSWORD")
+    DB_PORT = int(os.getenv("DB_PORT", 5432))
+    DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+    DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+    # Chat history is written behind the reply in batches
+    HISTORY_WRITE_BATCH = int(os.getenv("HISTORY_WRITE_BATCH", 50))
+    HISTORY_WRITE_INTERVAL = float(os.getenv("HISTORY_WRITE_INTERVAL", 2.0))
+    # Monthly articles partitions older than this are dropped, 0 keeps everything
+    ARTICLES_RETENTION_MONTHS = int(os.getenv("ARTICLES_RETENTION_MONTHS", 0))
+
+    # Redis
+    REDIS_URL = os.getenv("REDIS_URL")
+    ARTICLE_CACHE_TTL = int(os.getenv("ARTICLE_CACHE_TTL", 10 * 60))
+
+    # Crawling, seconds a fetch_stock_news task waits for its crawl
+    CRAWL_TIMEOUT = int(os.getenv("CRAWL_TIMEOUT", 10 * 60))
+    # A stock crawled less than CRAWL_FRESHNESS seconds ago is not crawled again, and
+    # requests for a stock being crawled attach to that crawl
+    CRAWL_FRESHNESS = int(os.getenv("CRAWL_FRESHNESS", 10 * 60))
+    CRAWL_LOCK_TTL = int(os.getenv("CRAWL_LOCK_TTL", 15 * 60))
+
+    # Per-user sessions
+    SESSION_MAX_USERS = int(os.getenv("SESSION_MAX_USERS", 10000))
+    SESSION_TTL = int(os.getenv("SESSION_TTL", 24 * 60 * 60))
+    SESSION_LOCAL_TTL = int(os.getenv("SESSION_LOCAL_TTL", 5))
+
+    # Per-user conversation memory
+    MEMORY_WINDOW = int(os.getenv("MEMORY_WINDOW", 5))
+    MEMORY_MAX_USERS = int(os.getenv("MEMORY_MAX_USERS", 1000))
+    MEMORY_TTL = int(os.getenv("MEMORY_TTL", 60 * 60))
+    # Rolling summary + recent turns, HISTORY_TOKEN_BUDGET=0 falls back to the raw window
+    HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", 1000))
+    HISTORY_RECENT_TURNS = int(os.getenv("HISTORY_RECENT_TURNS", 3))
+    HISTORY_TURN_TOKENS = int(os.getenv("HISTORY_TURN_TOKENS", 200))
+    HISTORY_SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", 300))
+
+    # LLM calls, timeouts in seconds
+    LLM_WORKERS = int(os.getenv("LLM_WORKERS", 12))
+    REPHRASE_TIMEOUT = float(os.getenv("REPHRASE_TIMEOUT", 15))
+    ANSWER_TIMEOUT = float(os.getenv("ANSWER_TIMEOUT", 60))
+    FURTHER_TIMEOUT = float(os.getenv("FURTHER_TIMEOUT", 20))
+    # One Perplexity call returns both the answer and the follow-up questions
+    # Log-odds above which the intent router sends a message to the rephrase chain.
+    # The baseline never rephrased typed chat, so only confident follow-ups pay for it
+    REPHRASE_MIN_SCORE = float(os.getenv("REPHRASE_MIN_SCORE", 2.5))
+    SINGLE_CALL_MODE = os.getenv("SINGLE_CALL_MODE", "false").lower() == "true"
+    SINGLE_CALL_MAX_TOKENS = int(os.getenv("SINGLE_CALL_MAX_TOKENS", 3072))
+    # Stream the Perplexity answer: first chunk as reply, the rest as push messages
+    STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "false").lower() == "true"
+    STREAM_FIRST_CHUNK = int(os.getenv("STREAM_FIRST_CHUNK", 60))
+    STREAM_CHUNK = int(os.getenv("STREAM_CHUNK", 1000))
+    # Answer chat, images and voice on the Celery "chat"/"media" queues instead of in
+    # the web process, results are pushed to the user
+    LLM_OFFLOAD = os.getenv("LLM_OFFLOAD", "false").lower() == "true"
+
+    # Exact-match cache of the rephrase / follow-up question chains
+    LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", 2048))
+    LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 60 * 60))
+
+    # Semantic cache of Perplexity answers: "off", "openai" or "hashing" (offline embeddings)
+    SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "off")
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.92))
+    SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", 1000))
+    SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", 30 * 60))
 
     # Other configurations
     PORT = int(os.getenv("PORT", 5000))
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 
+    # Webhook dispatch ("queue" hands events to a worker pool, "inline" handles them in the request)
+    DISPATCH_MODE = os.getenv("DISPATCH_MODE", "queue")
+    DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", 4))
+    DISPATCH_QUEUE_SIZE = int(os.getenv("DISPATCH_QUEUE_SIZE", 100))
+
     # Google Map API
     GOOGLE_MAP_API = os.getenv("GOOGLE_MAP_API")
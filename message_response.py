@@ -1,26 +1,33 @@
 # Standard library imports
 import os
+import re
 import json
 import base64
 import logging
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from datetime import datetime
 
 # Third-party library imports 
 import openai # type: ignore
 import requests
-import psycopg2 # type: ignore
 import googlemaps # type: ignore
 
 # Custom/Local imports
 from config import Config
 from utils.logger import setup_logger
+from utils.memory_manager import MemoryManager
+from utils.chat_history_writer import ChatHistoryWriter
+from utils.history_compactor import HistoryCompactor
+from utils.llm_cache import LLMResponseCache
+from utils.semantic_cache import SemanticCache, HashingEmbeddings
+from utils.intent_router import IntentRouter
+from utils.text_chunker import SentenceChunker
 
 # Langchain imports
-from langchain.memory import ConversationBufferWindowMemory # type: ignore
 from langchain.chains import ConversationChain # type: ignore
 from langchain_core.prompts import ChatPromptTemplate # type: ignore
 from langchain_community.chat_models import ChatPerplexity # type: ignore
-from langchain_openai import ChatOpenAI # type: ignore
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings # type: ignore
 
 logger = setup_logger()
 
@@ -33,14 +40,38 @@ class MessageResponse:
         self.DB_NAME = Config.DB_NAME
         self.DB_USER = Config.DB_USER
         self.DB_PASSWORD = Config.DB_PASSWORD
-        self.user_info = None
         openai.api_key = self.openai_api_key
+        # Per-user state, keyed by LINE user id
+        self.user_info = {}
         self.temp_images = {}
-        self.memory = ConversationBufferWindowMemory(k=5)
+        self.s3_urls = {}
+        self.memories = MemoryManager(
+            k=Config.MEMORY_WINDOW,
+            maxsize=Config.MEMORY_MAX_USERS,
+            ttl=Config.MEMORY_TTL,
+            redis_url=Config.REDIS_URL,
+            compactor=self.setup_history_compactor(),
+        )
+        self.llm_cache = LLMResponseCache(
+            maxsize=Config.LLM_CACHE_SIZE,
+            ttl=Config.LLM_CACHE_TTL,
+            redis_url=Config.REDIS_URL,
+        )
+        self.semantic_cache = self.setup_semantic_cache()
+        self.history_writer = ChatHistoryWriter(
+            batch_size=Config.HISTORY_WRITE_BATCH,
+            flush_interval=Config.HISTORY_WRITE_INTERVAL,
+        )
+        # Decides locally whether a message is worth the rephrase call
+        self.intent_router = IntentRouter.from_stock_list(min_score=Config.REPHRASE_MIN_SCORE)
+        # Runs the independent LLM calls of one message concurrently
+        self.executor = ThreadPoolExecutor(
+            max_workers=Config.LLM_WORKERS, thread_name_prefix="llm"
+        )
         self.setup_chat_models()
 
     def setup_chat_models(self) -> None:
-        """setup the model and prompt"""
+        """setup the model and prompt, the chains are bound to a user's memory in get_chain"""
         perplexity_chat = ChatPerplexity(
             temperature=0.2,
             model="llama-3.1-sonar-large-128k-online",
@@ -59,11 +90,26 @@ class MessageResponse:
         """
         )
 
-        self.conversation_with_summary = ConversationChain(
-            llm=perplexity_chat,
-            prompt=translate_prompt,
-            memory=self.memory,
-            verbose=True,
+        # Answer and follow-up questions in one round trip, see single_call_response
+        answer_with_questions_prompt = ChatPromptTemplate.from_template(
+            """
+        You are a helpful assistant. Please respond in traditional Chinese (繁體中文).
+        只回傳一個 JSON 物件，不要加入任何其他文字，格式如下：
+        {{"answer": "對用戶訊息的完整回答", "follow_ups": ["問題1", "問題2", "..."]}}
+        follow_ups 是10個用戶接下來可以提問給 LLM 的問題。
+
+        {history}
+
+        User: {input}
+        Assistant:
+        """
+        )
+        # The answer and ten follow-ups share this budget, a cut payload loses its end
+        self.answer_with_questions = answer_with_questions_prompt | ChatPerplexity(
+            temperature=0.2,
+            model="llama-3.1-sonar-large-128k-online",
+            pplx_api_key=self.Preplexity_API_KEY,
+            max_tokens=Config.SINGLE_CALL_MAX_TOKENS,
         )
 
         gpt_mini = ChatOpenAI(
@@ -86,12 +132,6 @@ class MessageResponse:
         """
         )
 
-        self.rephrase_conversation = ConversationChain(
-            llm=gpt_mini,
-            prompt=rephrase_prompt,
-            memory=self.memory,
-            verbose=False,
-        )
 
         further_prompt = ChatPromptTemplate.from_template(
             """
@@ -106,12 +146,6 @@ class MessageResponse:
         """
         )
 
-        self.further_conversation = ConversationChain(
-            llm=gpt_mini,
-            prompt=further_prompt,
-            memory=self.memory,
-            verbose=False,
-        )
 
         location_info_prompt = ChatPromptTemplate.from_template(
             """
@@ -126,44 +160,212 @@ class MessageResponse:
         """
         )
 
-        self.location_info_conversation = ConversationChain(
-            llm=gpt_mini,
-            prompt=location_info_prompt,
-            memory=self.memory,
-            verbose=True,
+        # name -> (llm, prompt, verbose)
+        self.chain_specs = {
+            "conversation_with_summary": (perplexity_chat, translate_prompt, True),
+            "rephrase_conversation": (gpt_mini, rephrase_prompt, False),
+            "further_conversation": (gpt_mini, further_prompt, False),
+            "location_info_conversation": (gpt_mini, location_info_prompt, True),
+        }
+
+    def setup_history_compactor(self):
+        """Summary plus recent turns under HISTORY_TOKEN_BUDGET, None keeps the raw window."""
+        if Config.HISTORY_TOKEN_BUDGET <= 0:
+            return None
+        summary_llm = ChatOpenAI(
+            openai_api_key=self.openai_api_key,
+            model_name="gpt-4o-mini",
+            temperature=0.2,
+            max_tokens=Config.HISTORY_SUMMARY_TOKENS * 2,
+        )
+        return HistoryCompactor(
+            summary_llm,
+            recent_turns=Config.HISTORY_RECENT_TURNS,
+            token_budget=Config.HISTORY_TOKEN_BUDGET,
+            turn_tokens=Config.HISTORY_TURN_TOKENS,
+            summary_tokens=Config.HISTORY_SUMMARY_TOKENS,
+        )
+
+    def setup_semantic_cache(self):
+        """Semantic cache of Perplexity answers, None when SEMANTIC_CACHE is off."""
+        if Config.SEMANTIC_CACHE == "openai":
+            embeddings = OpenAIEmbeddings(
+                openai_api_key=self.openai_api_key, model="text-embedding-3-small"
+            )
+        elif Config.SEMANTIC_CACHE == "hashing":
+            embeddings = HashingEmbeddings()
+        else:
+            return None
+        return SemanticCache(
+            embeddings,
+            threshold=Config.SEMANTIC_CACHE_THRESHOLD,
+            maxsize=Config.SEMANTIC_CACHE_SIZE,
+            ttl=Config.SEMANTIC_CACHE_TTL,
         )
 
+    def get_chain(self, name, memory) -> ConversationChain:
+        """Build the named chain on top of one user's memory, cheap next to the LLM call."""
+        llm, prompt, verbose = self.chain_specs[name]
+        return ConversationChain(llm=llm, prompt=prompt, memory=memory, verbose=verbose)
+
     def Perplexity_response(self, user_id, msg, rephrase=False) -> str:
         """Perplexity response."""
+        if Config.SINGLE_CALL_MODE:
+            return self.single_call_response(user_id, msg, rephrase)
         try:
-            history = self.get_conversation_history(
-                self.conversation_with_summary.memory
-            )
-            if rephrase:
-                rephrased_msg = self.rephrase_user_input(msg, history)
-                input_msg = rephrased_msg
-            else:
-                rephrased_msg = None
-                input_msg = msg
+            memory = self.memories.get(user_id)
+            history = self.get_conversation_history(memory)
+            turn = memory.begin_turn()
 
-            # Execute sequentially instead of concurrently
-            response = self.conversation_with_summary.invoke({"input": input_msg})
-            further_questions = self.further_question(msg, history)
+            # The follow-up questions only need msg and history, start them first
+            # and let them run while the (optional) rephrase and the answer run
+            further_future = self.executor.submit(self.further_question, msg, history)
+            rephrased_msg, input_msg = self.maybe_rephrase(msg, history, rephrase)
+
+            answer_future = self.executor.submit(
+                self.answer, memory, input_msg, self.is_standalone(msg, history, rephrased_msg)
+            )
+            # No default, a missing answer is an error
+            response = answer_future.result(timeout=Config.ANSWER_TIMEOUT)
+            further_questions = self._result(
+                further_future, Config.FURTHER_TIMEOUT, "further question", default=""
+            )
+            self.memories.save(user_id, memory)
 
             logger.debug(f"Response: {response}")
 
-            if self.user_info:
-                msg = f"{self.user_info} | {msg}"
-                self.user_info = None
+            user_info = self.user_info.pop(user_id, None)
+            if user_info:
+                msg = f"{user_info} | {msg}"
 
             self.save_chat_history(
-                user_id, msg, rephrased_msg, history, response["response"]
+                user_id, msg, rephrased_msg, turn, response["response"]
             )
             return response["response"], further_questions
         except Exception as e:
             logger.error(f"Error running the chain: {e}")
             return "Error", "Error"
 
+    def maybe_rephrase(self, msg, history, rephrase):
+        """
+        Rephrase msg when asked to and the intent router finds it depends on the history.
+        Returns (rephrased message or None, message to answer).
+        """
+        if not rephrase or not self.intent_router.needs_rephrase(msg, history):
+            return None, msg
+        rephrased_msg = self._result(
+            self.executor.submit(self.rephrase_user_input, msg, history),
+            Config.REPHRASE_TIMEOUT,
+            "rephrase",
+            default=msg,
+        )
+        return rephrased_msg, rephrased_msg
+
+    @staticmethod
+    def is_standalone(msg, history, rephrased_msg) -> bool:
+        """
+        Whether the message to answer reads the same for every user: there was no
+        history, or the rephrase rewrote it into a standalone question.
+        """
+        return not history.strip() or rephrased_msg not in (None, msg)
+
+    def answer(self, memory, input_msg, standalone=False) -> dict:
+        """
+        Perplexity answer, served from the semantic cache for near-duplicate questions.
+        The cache is keyed on the question only, so only standalone questions use it:
+        an answer built on one user's history must not reach another user.
+        """
+        vector = None
+        if self.semantic_cache is not None and standalone:
+            try:
+                vector = self.semantic_cache.embed(input_msg)
+                cached = self.semantic_cache.search(vector)
+            except Exception as e:
+                logger.error(f"Semantic cache lookup failed: {e}")
+                cached = None
+            if cached is not None:
+                memory.save_context({"input": input_msg}, {"response": cached})
+                return {"input": input_msg, "response": cached}
+
+        response = self.get_chain("conversation_with_summary", memory).invoke(
+            {"input": input_msg}
+        )
+        if vector is not None:
+            self.semantic_cache.add(vector, response["response"])
+        return response
+
+    def single_call_response(self, user_id, msg, rephrase=False) -> str:
+        """Perplexity answer and follow-up questions from a single model call."""
+        try:
+            memory = self.memories.get(user_id)
+            history = self.get_conversation_history(memory)
+            turn = memory.begin_turn()
+            rephrased_msg, input_msg = self.maybe_rephrase(msg, history, rephrase)
+
+            output = self.executor.submit(
+                self.answer_with_questions.invoke, {"history": history, "input": input_msg}
+            ).result(timeout=Config.ANSWER_TIMEOUT)
+            answer, questions = parse_answer_payload(output.content)
+            further_questions = "\n".join(
+                f"{i}. {question}" for i, question in enumerate(questions, start=1)
+            )
+
+            # Remember the answer only, not the JSON around it
+            memory.save_context({"input": input_msg}, {"response": answer})
+            self.memories.save(user_id, memory)
+
+            user_info = self.user_info.pop(user_id, None)
+            if user_info:
+                msg = f"{user_info} | {msg}"
+
+            self.save_chat_history(user_id, msg, rephrased_msg, turn, answer)
+            return answer, further_questions
+        except Exception as e:
+            logger.error(f"Error running the single call chain: {e}")
+            return "Error", "Error"
+
+    def stream_response(self, user_id, msg, rephrase=False):
+        """
+        Streaming variant of Perplexity_response.
+        Returns a generator of LINE-sized answer chunks, cut at sentence boundaries
+        as the tokens arrive, and a future holding the follow-up questions.
+        """
+        memory = self.memories.get(user_id)
+        history = self.get_conversation_history(memory)
+        turn = memory.begin_turn()
+        further_future = self.executor.submit(self.further_question, msg, history)
+        rephrased_msg, input_msg = self.maybe_rephrase(msg, history, rephrase)
+
+        def chunks():
+            llm, prompt, _ = self.chain_specs["conversation_with_summary"]
+            chunker = SentenceChunker(
+                first_size=Config.STREAM_FIRST_CHUNK, size=Config.STREAM_CHUNK
+            )
+            parts = []
+            for token in (prompt | llm).stream({"history": history, "input": input_msg}):
+                parts.append(token.content)
+                yield from chunker.feed(token.content)
+            yield from chunker.flush()
+
+            # Same bookkeeping as the ConversationChain does for Perplexity_response
+            answer = "".join(parts)
+            memory.save_context({"input": input_msg}, {"response": answer})
+            self.memories.save(user_id, memory)
+            user_info = self.user_info.pop(user_id, None)
+            saved_msg = f"{user_info} | {msg}" if user_info else msg
+            self.save_chat_history(user_id, saved_msg, rephrased_msg, turn, answer)
+
+        return chunks(), further_future
+
+    def _result(self, future, timeout, name, default):
+        """Wait for one branch of Perplexity_response, fall back to default on timeout."""
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            # The thread keeps running, its result is simply ignored
+            logger.warning(f"{name} did not finish within {timeout}s")
+            return default
+
     def get_conversation_history(self, memory) -> str:
         """
         從 ConversationBufferWindowMemory 中提取對話歷史，並格式化為文本。
@@ -174,13 +376,28 @@ class MessageResponse:
         memory_vars = memory.load_memory_variables({})
         return memory_vars.get("history", "")
 
+    def cached_invoke(self, name, history, text) -> str:
+        """
+        Invoke a gpt-4o-mini prompt unless the same (history, input) was answered before.
+        These helper prompts read the user's history but are not written to the memory,
+        which only holds the turns the user saw.
+        """
+        llm, prompt, _ = self.chain_specs[name]
+        key = self.llm_cache.make_key(
+            getattr(llm, "model_name", None), prompt.pretty_repr(), history, text
+        )
+        response = self.llm_cache.get(key)
+        if response is not None:
+            logger.debug(f"LLM cache hit for {name}: {self.llm_cache.stats()}")
+            return response
+        response = (prompt | llm).invoke({"history": history, "input": text}).content
+        self.llm_cache.set(key, response)
+        return response
+
     def rephrase_user_input(self, text, history) -> str:
         """Rephrase user message based on previous message so that LLM can better understand."""
         try:
-            rephrase_response = self.rephrase_conversation.invoke(
-                {"history": history, "input": text}
-            )
-            return rephrase_response["response"]
+            return self.cached_invoke("rephrase_conversation", history, text)
         except Exception as e:
             logging.error(f"重新表述時出錯: {e}")
             return text  # 如果重新表述失敗，回傳原始輸入
@@ -188,10 +405,7 @@ class MessageResponse:
     def further_question(self, text, history) -> str:
         """Provide user further questions to ask."""
         try:
-            further_questions_response = self.further_conversation.invoke(
-                {"history": history, "input": text}
-            )
-            return further_questions_response["response"]
+            return self.cached_invoke("further_conversation", history, text)
         except Exception as e:
             logger.error(f"Error: {e}")
             return text
@@ -224,16 +438,22 @@ class MessageResponse:
     def store_temp_image(self, user_id, image_path, s3_url) -> None:
         """Store the temporary image path for a user."""
         self.temp_images[user_id] = image_path
-        self.s3_url = s3_url
+        self.s3_urls[user_id] = s3_url
 
     def clear_temp_image(self, user_id) -> None:
         """Clear the temporary image path for a user."""
         if user_id in self.temp_images:
             del self.temp_images[user_id]
 
-    def process_image_with_info(self, image_path, additional_info) -> str:
+    def process_image_with_info(self, user_id, image_path, additional_info) -> str:
         """Process the image with additional information using ChatGPT API."""
-        self.user_info = additional_info
+        with open(image_path, "rb") as image_file:
+            image_base64 = base64.b64encode(image_file.read()).decode("utf-8")
+        return self.analyze_image(user_id, image_base64, additional_info)
+
+    def analyze_image(self, user_id, image_base64, additional_info) -> str:
+        """Same as process_image_with_info for a base64 JPEG, e.g. shipped to a Celery task."""
+        self.user_info[user_id] = additional_info
         # Prepare the content list with text and images
         content = [
             {
@@ -242,8 +462,6 @@ class MessageResponse:
             }
         ]
         # Add each image to the content list
-        with open(image_path, "rb") as image_file:
-            image_base64 = base64.b64encode(image_file.read()).decode("utf-8")
         content.append(
             {
                 "type": "image_url",
@@ -266,64 +484,45 @@ class MessageResponse:
         )
         return response.json()["choices"][0]["message"]["content"]
 
-    def clear_memory(self) -> None:
-        """Clear all memory"""
-        self.memory.clear()
+    def clear_memory(self, user_id) -> None:
+        """Clear the memory of one user"""
+        self.memories.clear(user_id)
 
     def save_chat_history(
-        self, user_id, user_msg, rephrase_msg, history, response
+        self, user_id, user_msg, rephrase_msg, turn, response
     ) -> None:
-        """Save chat history to PostgreSQL database."""
-        try:
-            conn = psycopg2.connect(
-                host=self.DB_HOST,
-                port="5432",
-                database=self.DB_NAME,
-                user=self.DB_USER,
-                password=self.DB_PASSWORD,
-            )
-            cur = conn.cursor()
-            s3_url = getattr(self, "s3_url", None)
-            history_json = json.dumps(history) if history else None
-            logger.info(
-                f"Storing data for user {user_id}:\n"
-                f"User message: {user_msg}\n"
-                f"Rephrased message: {rephrase_msg}\n"
-                f"Image URL: {s3_url}\n"
-                f"History: {history_json}\n"
-                f"Response: {response}\n"
-                f"Timestamp: {datetime.now()}"
-            )
-            cur.execute(
-                """
-                INSERT INTO chat_history (user_id, user_msg, rephrase_msg, image, history, response, timestamp)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-            """,
-                (
-                    user_id,
-                    user_msg,
-                    rephrase_msg,
-                    s3_url,
-                    history_json,
-                    response,
-                    datetime.now(),
-                ),
+        """
+        Queue one chat turn for the PostgreSQL write-behind writer.
+        ``turn`` comes from memory.begin_turn() and locates the history the prompt saw.
+        """
+        s3_url = self.s3_urls.pop(user_id, None)
+        logger.debug(
+            f"Storing turn {turn['seq']} of conversation {turn['conversation_id']} for user {user_id}:\n"
+            f"User message: {user_msg}\n"
+            f"Rephrased message: {rephrase_msg}\n"
+            f"Image URL: {s3_url}\n"
+            f"Response: {response}"
+        )
+        self.history_writer.save(
+            dict(
+                turn,
+                user_id=user_id,
+                user_msg=user_msg,
+                rephrase_msg=rephrase_msg,
+                image=s3_url,
+                response=response,
+                timestamp=datetime.now(),
             )
-            conn.commit()
-            cur.close()
-            conn.close()
-            if hasattr(self, "s3_url"):
-                del self.s3_url
-            logger.info(f"Chat history saved for user {user_id}")
-        except Exception as e:
-            logger.error(f"Error saving chat history: {e}")
+        )
 
-    def search_google_map(self, msg: str) -> str:
+    def search_google_map(self, user_id, msg: str) -> str:
         # Initialize the Google Maps client with your API key
         gmaps = googlemaps.Client(key=Config.GOOGLE_MAP_API)
 
         # Search for a place using text
-        query = self.location_info_conversation(msg)
+        query = self.get_chain(
+            "location_info_conversation", self.memories.get(user_id)
+        ).invoke({"input": msg})["response"]
         places_result = gmaps.places(query)
 
         for place in places_result['results']:
@@ -348,3 +547,91 @@ class MessageResponse:
                 print(f"No reviews available for {name}\n")
         pass
 
+
+def _load_payload(candidate):
+    """The JSON object in candidate, or None."""
+    try:
+        # Models often put raw newlines inside the strings
+        data = json.loads(candidate, strict=False)
+    except ValueError:
+        start, end = candidate.find("{"), candidate.rfind("}")
+        if start == -1 or end <= start:
+            return None
+        try:
+            data = json.loads(candidate[start:end + 1], strict=False)
+        except ValueError:
+            return None
+    return data if isinstance(data, dict) else None
+
+
+def _json_string_prefix(text, start) -> str:
+    """Decode the JSON string starting at text[start], even if it is cut off."""
+    end = start
+    while end < len(text) and text[end] != '"':
+        end += 2 if text[end] == "\\" else 1
+    raw = text[start:end]
+    # A cut can leave half an escape sequence (at most \uXXX) at the end
+    for cut in range(6):
+        try:
+            return json.loads(f'"{raw[:len(raw) - cut]}"', strict=False)
+        except ValueError:
+            continue
+    return raw
+
+
+def _truncated_payload(text):
+    """
+    What can be read from a payload cut off by max_tokens: the answer written so far
+    and the follow-ups that were complete. None without an answer.
+    """
+    match = re.search(r'"answer"\s*:\s*"', text)
+    if not match:
+        return None
+    answer = _json_string_prefix(text, match.end()).strip()
+    if not answer:
+        return None
+    follow_ups = []
+    match = re.search(r'"follow_ups"\s*:\s*\[', text)
+    if match:
+        follow_ups = [
+            _json_string_prefix(item + '"', 0)
+            for item in re.findall(r'"((?:[^"\\]|\\.)*)"\s*[,\]]', text[match.end():])
+        ]
+    return {"answer": answer, "follow_ups": follow_ups}
+
+
+def parse_answer_payload(text) -> tuple:
+    """
+    Parse the {"answer": ..., "follow_ups": [...]} payload of the single call prompt.
+    Models wrap it in code fences, add text around it or forget it entirely, and a
+    long answer can be cut off by max_tokens, so this never raises: a cut payload
+    keeps the answer written so far, anything else unparsable becomes the answer
+    with no follow-ups.
+    """
+    text = (text or "").strip()
+    candidates = [text]
+    fenced = re.search(r"```(?:json)?\s*(.*?)```", text, re.DOTALL)
+    if fenced:
+        # A fence inside the answer is matched too, so the whole text is tried next
+        candidates.insert(0, fenced.group(1))
+
+    data = None
+    for candidate in candidates:
+        data = _load_payload(candidate)
+        if data is not None and data.get("answer"):
+            break
+    else:
+        data = _truncated_payload(text)
+    if data is None:
+        return text, []
+
+    follow_ups = data.get("follow_ups") or []
+    if isinstance(follow_ups, str):
+        follow_ups = follow_ups.split("\n")
+    questions = []
+    for question in follow_ups:
+        # Drop the numbering the model sometimes adds, it is added back when sending
+        question = re.sub(r"^\s*\d+[.、)]\s*", "", str(question)).strip()
+        if question:
+            questions.append(question)
+    return str(data["answer"]).strip(), questions[:10]
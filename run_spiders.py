@@ -1,9 +1,16 @@
-from twisted.internet import reactor, defer # type: ignore
+import logging
+import threading
+import uuid
+from concurrent.futures import Future
+
+from twisted.internet import defer # type: ignore
 from scrapy.crawler import CrawlerRunner # type: ignore
 from scrapy.utils.log import configure_logging # type: ignore
-from twisted.internet.asyncioreactor import AsyncioSelectorReactor # type: ignore
-import asyncio
-from yahoo_news.spiders.news_search import NewsSearchSpider, AnueSearchSpider, ContentSpider
+from scrapy.utils.reactor import install_reactor # type: ignore
+from yahoo_news import settings
+from yahoo_news.spiders.news_search import (
+    NewsSearchSpider, AnueSearchSpider, ContentSpider, commit_high_water, mark_search_done,
+)
 
 configure_logging({"LOG_FORMAT": "%(levelname)s: %(message)s"})
 
@@ -12,30 +19,144 @@ def create_crawler_runner():
 
 @defer.inlineCallbacks
 def crawl(runner, stock_id):
-    yield runner.crawl(NewsSearchSpider, stock_id=stock_id)
-    yield runner.crawl(AnueSearchSpider, stock_id=stock_id)
-    yield runner.crawl(ContentSpider)
-    
-async def run_spiders_async(stock_id):
-    # Install AsyncioSelectorReactor if reactor not yet installed
-    if not reactor.running:
-        reactor._initInstalled = False
-        AsyncioSelectorReactor().install()
-    
-    runner = create_crawler_runner()
-    deferred = crawl(runner, stock_id)
-    deferred.addBoth(lambda _: reactor.stop())
-    
-    # Run reactor in a separate thread
-    reactor_thread = asyncio.get_event_loop()
-    await asyncio.get_event_loop().run_in_executor(None, reactor.run, True)
-    return True
-
-def run_spiders(stock_id):
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    return loop.run_until_complete(run_spiders_async(stock_id))
+    if settings.PIPELINED_CRAWL:
+        yield crawl_pipelined(runner, stock_id)
+        return
+    # Each run has its own link queue, concurrent runs don't consume each other's links
+    run_id = uuid.uuid4().hex
+    yield runner.crawl(NewsSearchSpider, stock_id=stock_id, run_id=run_id)
+    yield runner.crawl(AnueSearchSpider, stock_id=stock_id, run_id=run_id)
+    content = runner.create_crawler(ContentSpider)
+    yield runner.crawl(content, run_id=run_id)
+    finish_run(content, run_id, stock_id)
+
+@defer.inlineCallbacks
+def crawl_pipelined(runner, stock_id):
+    """
+    Both search spiders run at once while ContentSpider fetches the links they queue.
+    ContentSpider stays open until the searches signal completion and the queue is empty.
+    """
+    run_id = uuid.uuid4().hex
+    searches = defer.DeferredList(
+        [
+            runner.crawl(NewsSearchSpider, stock_id=stock_id, run_id=run_id),
+            runner.crawl(AnueSearchSpider, stock_id=stock_id, run_id=run_id),
+        ],
+        consumeErrors=True,
+    )
+    content = runner.create_crawler(ContentSpider)
+    content_done = runner.crawl(content, run_id=run_id, stream=True)
+    # Signal completion even if a search failed, or ContentSpider would never close
+    searches.addBoth(lambda _: mark_search_done(run_id))
+    yield searches
+    yield content_done
+    finish_run(content, run_id, stock_id)
+
+# ContentSpider stats counting links of the run that were not stored
+INCOMPLETE_STATS = ("content/download_failed", "content/parse_failed", "postgres/failed")
+
+def finish_run(content, run_id, stock_id):
+    """Move the high-water marks forward if ContentSpider stored every link of the run."""
+    stats = content.stats
+    if stats.get_value("finish_reason") == "finished" and not any(
+        stats.get_value(name) for name in INCOMPLETE_STATS
+    ):
+        try:
+            commit_high_water(run_id, stock_id)
+        except Exception as e:
+            # Only costs a deeper search next time
+            logging.error(f"Failed to commit the high-water marks of {stock_id}: {e}")
+    else:
+        # The next run pages as deep as this one did and picks up what was lost
+        logging.warning(f"Crawl {run_id} of {stock_id} incomplete, high-water marks kept")
+
+
+class CrawlService:
+    """
+    One Twisted reactor running for the life of the process in a dedicated thread.
+    A reactor cannot be restarted, so instead of one reactor per crawl every crawl is
+    scheduled onto this one; submit() is thread-safe and returns a Future.
+    """
+
+    def __init__(self):
+        self.reactor = None
+        self.runner = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+        # Why the reactor is not (or no longer) running, raised to every caller
+        self._error = None
+
+    def start(self, timeout=30):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="crawl-reactor", daemon=True)
+                self._thread.start()
+        if not self._ready.wait(timeout):
+            raise RuntimeError(f"Crawl reactor did not start within {timeout}s")
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        try:
+            install_reactor("twisted.internet.asyncioreactor.AsyncioSelectorReactor")
+            from twisted.internet import reactor # type: ignore
+
+            self.reactor = reactor
+            self.runner = create_crawler_runner()
+        except Exception as e:
+            logging.error(f"Failed to start the crawl reactor: {e}")
+            self._error = e
+            return
+        finally:
+            self._ready.set()
+        try:
+            # Signal handlers can only be installed from the main thread
+            reactor.run(installSignalHandlers=False)
+        finally:
+            # A stopped reactor can't run again, fail the crawls instead of hanging them
+            self._error = RuntimeError("Crawl reactor stopped")
+
+    def submit(self, stock_id) -> Future:
+        """Schedule a crawl of one stock, concurrently with the others in flight."""
+        self.start()
+        future = Future()
+
+        def schedule():
+            if not future.set_running_or_notify_cancel():
+                return
+            deferred = crawl(self.runner, stock_id)
+            deferred.addCallbacks(
+                lambda _: future.set_result(True),
+                lambda failure: future.set_exception(failure.value),
+            )
+
+        self.reactor.callFromThread(schedule)
+        return future
+
+    def stop(self):
+        if self.reactor is not None and self.reactor.running:
+            self.reactor.callFromThread(self.reactor.stop)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_crawl_service() -> CrawlService:
+    """Process-wide crawl service, created on first use (after forking)."""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = CrawlService()
+    return _service
+
+
+def run_spiders(stock_id, timeout=None):
+    """Crawl one stock and wait for it, on the process-wide crawl service."""
+    return get_crawl_service().submit(stock_id).result(timeout)
 
 # Example usage in the same file
 if __name__ == "__main__":
-    run_spiders(stock_id="2330")
\ No newline at end of file
+    run_spiders(stock_id="2330")
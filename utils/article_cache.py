@@ -0,0 +1,94 @@
+import json
+from datetime import datetime
+
+import redis # type: ignore
+
+from utils.logger import setup_logger
+from utils.stock_articles import SUMMARY_COLUMNS, count_recent_articles, list_recent_articles
+
+logger = setup_logger()
+
+
+def version_key(stock_id) -> str:
+    return f"articles:version:{int(stock_id)}"
+
+
+def bump_article_version(redis_client, *stock_ids) -> None:
+    """
+    Invalidate the cached lookups of some stocks, call it after new articles are committed.
+    Entries are keyed by version, so bumping it orphans every entry of the stock at once.
+    """
+    pipe = redis_client.pipeline()
+    for stock_id in set(stock_ids):
+        pipe.incr(version_key(stock_id))
+    pipe.execute()
+
+
+def _encode_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+class ArticleCache:
+    """
+    Read-through Redis cache in front of utils.stock_articles, keyed by stock id,
+    window and the stock's version number which PostgresPipeline bumps on insert.
+    Without a Redis URL every call goes straight to PostgreSQL.
+    """
+
+    def __init__(self, redis_url=None, ttl=10 * 60, prefix="articles:") -> None:
+        self.ttl = ttl
+        self.prefix = prefix
+        self.redis = redis.Redis.from_url(redis_url) if redis_url else None
+
+    def count(self, stock_id, days=30) -> int:
+        return self._read_through(
+            stock_id,
+            f"{days}:count",
+            lambda: count_recent_articles(stock_id, days),
+            str,
+            int,
+        )
+
+    def list(self, stock_id, days=30, columns=SUMMARY_COLUMNS) -> list:
+        """Same as list_recent_articles, dates come back as ISO strings."""
+        columns = tuple(columns)
+
+        def encode(articles):
+            # Rows as arrays with the column names once, instead of one dict per row
+            rows = [[_encode_value(a[c]) for c in columns] for a in articles]
+            return json.dumps({"c": columns, "r": rows}, ensure_ascii=False, separators=(",", ":"))
+
+        def decode(raw):
+            data = json.loads(raw)
+            return [dict(zip(data["c"], row)) for row in data["r"]]
+
+        articles = self._read_through(
+            stock_id,
+            f"{days}:list:{','.join(columns)}",
+            lambda: list_recent_articles(stock_id, days, columns),
+            encode,
+            decode,
+        )
+        return [{c: _encode_value(v) for c, v in a.items()} for a in articles]
+
+    def _read_through(self, stock_id, name, load, encode, decode):
+        if self.redis is None:
+            return load()
+        try:
+            version = int(self.redis.get(version_key(stock_id)) or 0)
+            key = f"{self.prefix}{int(stock_id)}:v{version}:{name}"
+            raw = self.redis.get(key)
+            if raw is not None:
+                return decode(raw)
+        except redis.RedisError as e:
+            logger.error(f"Article cache read failed for {stock_id}: {e}")
+            return load()
+
+        value = load()
+        try:
+            # Written under the version read before loading: if new rows landed in
+            # between, the version moved on and this entry is never read
+            self.redis.set(key, encode(value), ex=self.ttl)
+        except redis.RedisError as e:
+            logger.error(f"Article cache write failed for {stock_id}: {e}")
+        return value
@@ -0,0 +1,202 @@
+import atexit
+import queue
+import threading
+import time
+
+import psycopg2 # type: ignore
+from psycopg2.extras import execute_values # type: ignore
+from psycopg2.pool import PoolError # type: ignore
+
+from utils.db import connection
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+TURN_COLUMNS = (
+    "conversation_id", "seq", "user_id", "user_msg", "rephrase_msg", "image",
+    "response", "window_start", "summary_version", "timestamp",
+)
+
+
+class ChatHistoryWriter:
+    """
+    Write-behind persistence of chat turns (chat_turns) and conversation summaries
+    (chat_summaries), see utils/schema.py.
+    save() only puts the row on a bounded queue; a background thread inserts the
+    rows in batches once ``batch_size`` rows are waiting or ``flush_interval``
+    seconds have passed, and flushes what is left when the process exits.
+    A batch that hits a connection error is retried ``max_retries`` times with
+    exponential backoff; a batch with bad data is retried row by row.
+    """
+
+    def __init__(
+        self, batch_size=50, flush_interval=2.0, max_queue_size=10000, max_retries=5, retry_delay=0.5,
+    ) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.rows = queue.Queue(maxsize=max_queue_size)
+        self.dropped = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def save(self, row) -> None:
+        """
+        Queue one turn, never blocks: turns are dropped (and counted) when the queue is full.
+        ``row`` is a dict with the chat_turns columns and the ``summary`` it references, if any.
+        """
+        self._ensure_started()
+        try:
+            self.rows.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            logger.error(f"Chat history queue is full, dropped a row ({self.dropped} so far)")
+
+    def close(self) -> None:
+        """Stop the background thread after flushing every queued row."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout=10)
+
+    def _ensure_started(self) -> None:
+        # Started lazily so the thread lives in the process that uses it
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="chat-history-writer", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self) -> None:
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while not self._stop.is_set():
+            try:
+                batch.append(self.rows.get(timeout=max(deadline - time.monotonic(), 0.01)))
+            except queue.Empty:
+                pass
+            if len(batch) >= self.batch_size or (batch and time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + self.flush_interval
+
+        # Shutting down, drain the queue
+        while True:
+            try:
+                batch.append(self.rows.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._flush(batch)
+
+    def _write(self, batch) -> None:
+        # Turns of one conversation repeat the summary they reference, send each once
+        summaries = list({
+            (row["conversation_id"], row["summary_version"]): (
+                row["conversation_id"], row["summary_version"], row["summary"]
+            )
+            for row in batch
+            if row.get("summary")
+        }.values())
+        turns = [tuple(row[column] for column in TURN_COLUMNS) for row in batch]
+        with connection() as conn:
+            with conn.cursor() as cur:
+                if summaries:
+                    execute_values(
+                        cur,
+                        """
+                        INSERT INTO chat_summaries (conversation_id, version, summary)
+                        VALUES %s
+                        ON CONFLICT DO NOTHING
+                        """,
+                        summaries,
+                    )
+                execute_values(
+                    cur,
+                    f"""
+                    INSERT INTO chat_turns ({", ".join(TURN_COLUMNS)})
+                    VALUES %s
+                    ON CONFLICT (conversation_id, seq) DO NOTHING
+                    """,
+                    turns,
+                    page_size=self.batch_size,
+                )
+
+    def _flush(self, batch) -> None:
+        start = time.monotonic()
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._write(batch)
+                logger.info(
+                    f"Saved {len(batch)} chat turns in {time.monotonic() - start:.3f}s"
+                )
+                return
+            except (psycopg2.OperationalError, psycopg2.InterfaceError, PoolError) as e:
+                # Connection lost, failover... the pool hands out a fresh connection next time
+                if attempt == self.max_retries:
+                    break
+                delay = self.retry_delay * 2 ** attempt
+                logger.warning(
+                    f"Saving {len(batch)} chat history rows failed, retrying in {delay}s: {e}"
+                )
+                time.sleep(delay)
+            except Exception as e:
+                if len(batch) == 1:
+                    logger.error(f"Error saving chat turn {batch[0]['seq']} of {batch[0]['conversation_id']}: {e}")
+                    break
+                logger.error(f"Error saving {len(batch)} chat history rows, saving them one by one: {e}")
+                for row in batch:
+                    self._flush([row])
+                return
+        self.dropped += len(batch)
+        logger.error(f"Dropped {len(batch)} chat history rows ({self.dropped} so far)")
+
+
+def load_turn_history(conn, conversation_id, seq) -> tuple:
+    """
+    Rebuild what the prompt of turn ``seq`` saw: (summary or None, [(human, ai), ...]).
+    The human side is the rephrased message when there was one, as in the memory.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT window_start, summary_version
+            FROM chat_turns
+            WHERE conversation_id = %s AND seq = %s
+            """,
+            (conversation_id, seq),
+        )
+        row = cur.fetchone()
+        if row is None:
+            return None, []
+        window_start, summary_version = row
+
+        summary = None
+        if summary_version:
+            cur.execute(
+                """
+                SELECT summary FROM chat_summaries
+                WHERE conversation_id = %s AND version = %s
+                """,
+                (conversation_id, summary_version),
+            )
+            found = cur.fetchone()
+            summary = found[0] if found else None
+
+        cur.execute(
+            """
+            SELECT COALESCE(rephrase_msg, user_msg), response
+            FROM chat_turns
+            WHERE conversation_id = %s AND seq >= %s AND seq < %s
+            ORDER BY seq
+            """,
+            (conversation_id, window_start, seq),
+        )
+        return summary, cur.fetchall()
@@ -0,0 +1,135 @@
+import threading
+import time
+import uuid
+from collections import Counter
+
+import redis # type: ignore
+
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+# Delete the lock only if this task still holds it
+_RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Status of a crawl request
+QUEUED = "queued"
+IN_FLIGHT = "in_flight"
+FRESH = "fresh"
+
+
+class CrawlCoalescer:
+    """
+    One crawl per stock at a time, and none while its last crawl is fresher than
+    ``freshness`` seconds. A per-stock Redis lock holds the id of the in-flight task,
+    so duplicate requests attach to it instead of queueing another crawl. The worker
+    calls finish() or release() when the task ends; the lock TTL covers lost workers.
+    Without Redis every request is queued.
+    """
+
+    def __init__(self, redis_url=None, freshness=10 * 60, lock_ttl=15 * 60, prefix="crawl:") -> None:
+        self.freshness = freshness
+        self.lock_ttl = lock_ttl
+        self.prefix = prefix
+        self.redis = redis.Redis.from_url(redis_url) if redis_url else None
+        self.release_script = self.redis.register_script(_RELEASE) if self.redis is not None else None
+        self.local_metrics = Counter()
+        self._lock = threading.Lock()
+
+    def _lock_key(self, stock_id) -> str:
+        return f"{self.prefix}lock:{stock_id}"
+
+    def _last_key(self, stock_id) -> str:
+        return f"{self.prefix}last:{stock_id}"
+
+    def _count(self, name) -> None:
+        if self.redis is not None:
+            try:
+                self.redis.hincrby(self.prefix + "metrics", name, 1)
+                return
+            except redis.RedisError as e:
+                logger.error(f"Failed to count crawl metric {name}: {e}")
+        with self._lock:
+            self.local_metrics[name] += 1
+
+    def request(self, stock_id, enqueue):
+        """
+        Ask for a crawl of a stock. ``enqueue(task_id)`` queues the task under that id
+        and is only called when no crawl is in flight or fresh.
+        Returns (status, task_id), task_id being the in-flight task when coalesced.
+        """
+        self._count("requested")
+        if self.redis is None:
+            task_id = str(uuid.uuid4())
+            enqueue(task_id)
+            self._count("enqueued")
+            return QUEUED, task_id
+        try:
+            last = self.redis.get(self._last_key(stock_id))
+            if last is not None and time.time() - float(last) < self.freshness:
+                self._count("skipped_fresh")
+                return FRESH, None
+            task_id = str(uuid.uuid4())
+            if not self.redis.set(self._lock_key(stock_id), task_id, nx=True, ex=self.lock_ttl):
+                in_flight = self.redis.get(self._lock_key(stock_id))
+                self._count("coalesced")
+                return IN_FLIGHT, in_flight.decode() if in_flight else None
+        except redis.RedisError as e:
+            logger.error(f"Crawl coalescing failed for {stock_id}, queueing anyway: {e}")
+            task_id = str(uuid.uuid4())
+            enqueue(task_id)
+            self._count("enqueued")
+            return QUEUED, task_id
+
+        try:
+            enqueue(task_id)
+        except Exception:
+            self.release(stock_id, task_id)
+            raise
+        self._count("enqueued")
+        return QUEUED, task_id
+
+    def finish(self, stock_id, task_id) -> None:
+        """Record a completed crawl: the stock is fresh and the next request may crawl."""
+        self._count("executed")
+        if self.redis is None:
+            return
+        try:
+            self.redis.set(self._last_key(stock_id), time.time(), ex=max(self.freshness, 1))
+            self.release_script(keys=[self._lock_key(stock_id)], args=[task_id])
+        except redis.RedisError as e:
+            logger.error(f"Failed to record the crawl of {stock_id}: {e}")
+
+    def release(self, stock_id, task_id, failed=False) -> None:
+        """Drop the lock of a task that will not finish, e.g. out of retries."""
+        if failed:
+            self._count("failed")
+        if self.redis is None:
+            return
+        try:
+            self.release_script(keys=[self._lock_key(stock_id)], args=[task_id])
+        except redis.RedisError as e:
+            logger.error(f"Failed to release the crawl lock of {stock_id}: {e}")
+
+    def stats(self) -> dict:
+        metrics = Counter(self.local_metrics)
+        if self.redis is not None:
+            try:
+                for name, value in self.redis.hgetall(self.prefix + "metrics").items():
+                    metrics[name.decode()] += int(value)
+            except redis.RedisError as e:
+                logger.error(f"Failed to read crawl metrics: {e}")
+        return {
+            "freshness": self.freshness,
+            "requested": metrics["requested"],
+            "enqueued": metrics["enqueued"],
+            "coalesced": metrics["coalesced"],
+            "skipped_fresh": metrics["skipped_fresh"],
+            "executed": metrics["executed"],
+            "failed": metrics["failed"],
+        }
@@ -0,0 +1,107 @@
+import redis # type: ignore
+from linebot.models import TextSendMessage # type: ignore
+
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+# LINE accepts at most 500 recipients per multicast
+MULTICAST_LIMIT = 500
+# Titles listed in a crawl result
+MAX_TITLES = 5
+
+
+def crawl_result_message(stock_id, new_articles, total) -> str:
+    if not new_articles:
+        return f"{stock_id} 沒有新的新聞，近 30 天共 {total} 篇文章。"
+    lines = [f"{stock_id} 新增 {len(new_articles)} 篇新聞，近 30 天共 {total} 篇文章："]
+    for article in new_articles[:MAX_TITLES]:
+        lines.append(f"• {article['title']}")
+    if len(new_articles) > MAX_TITLES:
+        lines.append(f"…等 {len(new_articles) - MAX_TITLES} 篇")
+    return "\n".join(lines)
+
+
+class CrawlNotifier:
+    """
+    Users waiting on a stock's background crawl, kept in a Redis set per stock.
+    The web app adds them when it queues or joins a crawl; the Celery task pops the
+    whole set when the crawl ends and pushes one message, multicast to the users.
+    Without Redis nobody is registered and nothing is pushed.
+    """
+
+    def __init__(self, redis_url=None, line_bot_api=None, ttl=15 * 60, prefix="crawl:waiters:") -> None:
+        self.redis = redis.Redis.from_url(redis_url) if redis_url else None
+        self.line_bot_api = line_bot_api
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def add_waiter(self, stock_id, target) -> bool:
+        """Register a user, group or room id; False if it could not be registered."""
+        if self.redis is None:
+            return False
+        try:
+            pipe = self.redis.pipeline()
+            pipe.sadd(self.prefix + str(stock_id), target)
+            pipe.expire(self.prefix + str(stock_id), self.ttl)
+            pipe.execute()
+            return True
+        except redis.RedisError as e:
+            logger.error(f"Failed to register {target} for the crawl of {stock_id}: {e}")
+            return False
+
+    def remove_waiter(self, stock_id, target) -> None:
+        if self.redis is None:
+            return
+        try:
+            self.redis.srem(self.prefix + str(stock_id), target)
+        except redis.RedisError as e:
+            logger.error(f"Failed to unregister {target} from the crawl of {stock_id}: {e}")
+
+    def has_waiters(self, stock_id) -> bool:
+        if self.redis is None:
+            return False
+        try:
+            return self.redis.scard(self.prefix + str(stock_id)) > 0
+        except redis.RedisError as e:
+            logger.error(f"Failed to read the waiters of {stock_id}: {e}")
+            return False
+
+    def pop_waiters(self, stock_id) -> list:
+        if self.redis is None:
+            return []
+        pipe = self.redis.pipeline()
+        pipe.smembers(self.prefix + str(stock_id))
+        pipe.delete(self.prefix + str(stock_id))
+        members, _ = pipe.execute()
+        return sorted(member.decode() for member in members)
+
+    def notify(self, stock_id, text) -> int:
+        """Push text to everyone waiting on the stock. Returns the number of recipients."""
+        try:
+            targets = self.pop_waiters(stock_id)
+        except redis.RedisError as e:
+            logger.error(f"Failed to read the waiters of {stock_id}: {e}")
+            return 0
+        if not targets:
+            return 0
+        message = TextSendMessage(text=text)
+        # Multicast only takes user ids, groups and rooms get their own push
+        users = [t for t in targets if t.startswith("U")]
+        others = [t for t in targets if not t.startswith("U")]
+        if len(users) == 1:
+            others += users
+            users = []
+        for start in range(0, len(users), MULTICAST_LIMIT):
+            chunk = users[start:start + MULTICAST_LIMIT]
+            try:
+                self.line_bot_api.multicast(chunk, message)
+            except Exception as e:
+                logger.error(f"Failed to multicast the crawl of {stock_id} to {len(chunk)} users: {e}")
+        for target in others:
+            try:
+                self.line_bot_api.push_message(target, message)
+            except Exception as e:
+                logger.error(f"Failed to push the crawl of {stock_id} to {target}: {e}")
+        logger.info(f"Notified {len(targets)} waiters of the crawl of {stock_id}")
+        return len(targets)
@@ -0,0 +1,46 @@
+import threading
+from contextlib import contextmanager
+
+from psycopg2.pool import ThreadedConnectionPool # type: ignore
+
+from config import Config
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ThreadedConnectionPool:
+    """Process-wide PostgreSQL connection pool, created on first use (after forking)."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(
+                    Config.DB_POOL_MIN,
+                    Config.DB_POOL_MAX,
+                    host=Config.DB_HOST,
+                    port=Config.DB_PORT,
+                    dbname=Config.DB_NAME,
+                    user=Config.DB_USER,
+                    password=Config.DB_PASSWORD,
+                )
+                logger.info(f"Opened PostgreSQL pool to {Config.DB_HOST}:{Config.DB_PORT}")
+    return _pool
+
+
+@contextmanager
+def connection():
+    """Borrow a pooled connection, committed on success and rolled back on error."""
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
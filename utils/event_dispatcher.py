@@ -0,0 +1,139 @@
+import queue
+import threading
+from collections import deque
+
+from linebot import WebhookHandler # type: ignore
+from linebot.models import MessageEvent # type: ignore
+
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+
+class QueueFullError(Exception):
+    """Raised when the dispatcher cannot admit the events of a webhook body."""
+
+
+class QueuedWebhookHandler(WebhookHandler):
+    """
+    WebhookHandler that only verifies and parses the body on the request thread.
+    The parsed events are queued per source (user, group or room) and a pool of
+    worker threads runs the handlers registered with ``@handler.add``.
+    Events of one source are handled one at a time in arrival order, while
+    different sources are handled in parallel.
+    """
+
+    def __init__(self, channel_secret, workers=4, max_queue_size=100) -> None:
+        super().__init__(channel_secret)
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        # source key -> events waiting for that source
+        self.pending = {}
+        # source keys that have events and no worker running them
+        self.ready = queue.Queue()
+        self._size = 0
+        self._threads = []
+        self._lock = threading.Lock()
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of events waiting for a worker."""
+        return self._size
+
+    def status(self) -> dict:
+        with self._lock:
+            sources = len(self.pending)
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_size": self.max_queue_size,
+            "active_sources": sources,
+            "workers": len(self._threads),
+        }
+
+    def handle(self, body, signature) -> None:
+        """Verify the signature and enqueue every event of the webhook body."""
+        payload = self.parser.parse(body, signature, as_payload=True)
+        self._ensure_started()
+
+        # Admit the whole body or nothing, LINE redelivers the body as a unit
+        with self._lock:
+            if self._size + len(payload.events) > self.max_queue_size:
+                raise QueueFullError(
+                    f"Dispatcher queue is full ({self._size}/{self.max_queue_size})"
+                )
+            for event in payload.events:
+                key = self.source_key(event)
+                if key not in self.pending:
+                    # No worker owns this source yet
+                    self.pending[key] = deque()
+                    self.ready.put(key)
+                self.pending[key].append((event, payload.destination))
+                self._size += 1
+
+    @staticmethod
+    def source_key(event) -> str:
+        """Partition key of an event: group or room for group chats, otherwise the user."""
+        source = getattr(event, "source", None)
+        if source is None:
+            return ""
+        return (
+            getattr(source, "group_id", None)
+            or getattr(source, "room_id", None)
+            or getattr(source, "user_id", None)
+            or ""
+        )
+
+    def dispatch(self, event, destination=None) -> None:
+        """Run the handler registered for the event, same lookup as WebhookHandler.handle."""
+        func = None
+        if isinstance(event, MessageEvent):
+            func = self._handlers.get(
+                self._handler_key(event.__class__, event.message.__class__)
+            )
+        if func is None:
+            func = self._handlers.get(self._handler_key(event.__class__))
+        if func is None:
+            func = self._default
+        if func is None:
+            logger.info(f"No handler of {event.__class__.__name__} and no default handler")
+            return
+        func(event)
+
+    @staticmethod
+    def _handler_key(event, message=None) -> str:
+        if message is None:
+            return event.__name__
+        return event.__name__ + "_" + message.__name__
+
+    def _ensure_started(self) -> None:
+        # Start the threads lazily so they are created after gunicorn forks
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._worker, name=f"line-dispatch-{i}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            logger.info(f"Started {self.workers} dispatch workers")
+
+    def _worker(self) -> None:
+        while True:
+            key = self.ready.get()
+            with self._lock:
+                event, destination = self.pending[key].popleft()
+            try:
+                self.dispatch(event, destination)
+            except Exception as e:
+                logger.exception(f"Error handling event {event.__class__.__name__}: {e}")
+            finally:
+                with self._lock:
+                    self._size -= 1
+                    if self.pending[key]:
+                        # Go to the back of the line so one chatty source cannot starve others
+                        self.ready.put(key)
+                    else:
+                        del self.pending[key]
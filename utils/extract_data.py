@@ -1,43 +1,11 @@
-import psycopg2
-import json
-from datetime import datetime, timedelta
-from config import Config
+from utils.stock_articles import list_recent_articles
 
 
 def pg_extract(stock_id):
-    conn = psycopg2.connect(
-        host=Config.DB_HOST,
-        port=6379,
-        dbname=Config.DB_NAME,
-        user=Config.DB_USER,
-        password=Config.DB_PASSWORD,
+    """Articles of the last 30 days with their content, kept for older callers."""
+    articles = list_recent_articles(
+        stock_id, days=30, columns=("id", "title", "content", "url", "date")
     )
-    cur = conn.cursor()
-    
-    # Get data from last 30 days
-    cur.execute(f"""
-        SELECT id, title, content, url, date 
-        FROM articles
-        WHERE date >= NOW() - INTERVAL '30 days' AND stock_id = {stock_id}
-        ORDER BY date DESC
-    """)
-    
-    # Fetch all results
-    rows = cur.fetchall()
-    
-    # Convert to list of dictionaries
-    articles = []
-    for row in rows:
-        article = {
-            'id': row[0],
-            'title': row[1],
-            'content': row[2],
-            'url': row[3],
-            'date': row[4].isoformat() if row[4] else None
-        }
-        articles.append(article)
-    
-    cur.close()
-    conn.close()
-    
+    for article in articles:
+        article["date"] = article["date"].isoformat() if article["date"] else None
     return articles
@@ -0,0 +1,134 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.messages import get_buffer_string # type: ignore
+from langchain_core.prompts import ChatPromptTemplate # type: ignore
+
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+try:
+    import tiktoken # type: ignore
+
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _encoding = None
+
+
+def count_tokens(text) -> int:
+    """Token count of text, estimated when tiktoken is not available."""
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # CJK characters are about one token each, other text about four characters per token
+    cjk = sum(1 for char in text if "⺀" <= char <= "鿿")
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+def truncate_tokens(text, limit) -> str:
+    if count_tokens(text) <= limit:
+        return text
+    if _encoding is not None:
+        return _encoding.decode(_encoding.encode(text)[:limit]) + "…"
+    # Cut proportionally and shrink until it fits
+    end = max(1, len(text) * limit // count_tokens(text))
+    while end > 1 and count_tokens(text[:end]) > limit:
+        end = end * 9 // 10
+    return text[:end] + "…"
+
+
+SUMMARY_PROMPT = ChatPromptTemplate.from_template(
+    """
+請將以下新的對話內容併入既有的對話摘要，保留用戶關心的主題、提到的股票/公司/地點與重要結論，
+只輸出更新後的摘要，不超過 {limit} 個字。
+
+既有摘要：
+{summary}
+
+新的對話：
+{new_lines}
+
+更新後的摘要：
+"""
+)
+
+
+class HistoryCompactor:
+    """
+    Keeps the history a prompt sees under a token budget: a rolling summary of the
+    older turns plus the last ``recent_turns`` turns, each cut to ``turn_tokens``.
+    Turns that fall out of the window are folded into the summary by ``llm`` on a
+    background thread, so the reply never waits for the summarization.
+    """
+
+    def __init__(
+        self, llm, recent_turns=3, token_budget=1000, turn_tokens=200, summary_tokens=300
+    ) -> None:
+        self.llm = llm
+        self.recent_turns = recent_turns
+        self.token_budget = token_budget
+        self.turn_tokens = turn_tokens
+        self.summary_tokens = summary_tokens
+        self.chain = SUMMARY_PROMPT | llm
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+
+    def render(self, summary, pending, messages) -> str:
+        """History text for a prompt, newest turns first in line for the budget."""
+        parts = []
+        used = 0
+        if summary:
+            summary_text = "Summary: " + truncate_tokens(summary, self.summary_tokens)
+            used += count_tokens(summary_text)
+        for message in reversed(list(pending) + list(messages)):
+            line = get_buffer_string([message])
+            line = truncate_tokens(line, self.turn_tokens)
+            cost = count_tokens(line)
+            if used + cost > self.token_budget:
+                break
+            parts.append(line)
+            used += cost
+        parts.reverse()
+        if summary:
+            parts.insert(0, summary_text)
+        return "\n".join(parts)
+
+    def compact(self, memory) -> None:
+        """Move turns beyond the window to ``pending`` and summarize them in the background."""
+        keep = 2 * self.recent_turns
+        messages = memory.chat_memory.messages
+        if len(messages) <= keep:
+            return
+        memory.pending = memory.pending + messages[:-keep]
+        memory.chat_memory.messages = messages[-keep:]
+        # One summarization per memory at a time, a running one picks up new turns
+        if not memory.summarizing:
+            memory.summarizing = True
+            self.executor.submit(self._summarize, memory)
+
+    def _summarize(self, memory) -> None:
+        try:
+            while memory.pending:
+                pending = list(memory.pending)
+                conversation_id = memory.conversation_id
+                summary = self.chain.invoke(
+                    {
+                        "summary": memory.summary or "（無）",
+                        "new_lines": get_buffer_string(pending),
+                        "limit": self.summary_tokens,
+                    }
+                ).content
+                if memory.conversation_id != conversation_id:
+                    # Cleared while summarizing, the summary belongs to the old conversation
+                    logger.info("Dropping the summary of a cleared conversation")
+                    return
+                memory.summary = summary.strip()
+                memory.summary_version += 1
+                # Turns added to pending while the summary was running stay pending
+                memory.pending = memory.pending[len(pending):]
+                memory.first_seq += len(pending) // 2
+                if memory.on_compacted:
+                    memory.on_compacted()
+        except Exception as e:
+            # The pending turns stay in the prompt and are retried on the next turn
+            logger.error(f"Failed to update conversation summary: {e}")
+        finally:
+            memory.summarizing = False
@@ -0,0 +1,135 @@
+import json
+import os
+import re
+import threading
+from collections import Counter
+
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+STOCK_LIST_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "stock_list.json")
+
+STOCK_CODE = re.compile(r"(?<!\d)\d{4,6}(?!\d)")
+
+# Features of the history-dependence classifier with their weights. A message
+# scoring above the router's min_score is sent to the rephrase chain.
+REFERENCE_WORDS = (
+    "它", "他們", "她們", "這個", "那個", "這些", "那些", "這家", "那家", "這支", "那支",
+    "上述", "剛剛", "剛才", "前面", "之前", "上面", "其", "同樣",
+)
+FOLLOW_UP_OPENERS = ("那", "所以", "然後", "還有", "另外", "再", "也", "那麼", "and ", "so ", "what about", "how about")
+ENGLISH_REFERENCES = re.compile(r"\b(it|its|that|this|they|them|those|these|he|she)\b", re.IGNORECASE)
+QUESTION_WORDS = ("為什麼", "如何", "怎麼", "什麼", "多少", "哪", "是否", "嗎", "why", "how", "what", "which", "when")
+
+BIAS = -1.0
+WEIGHTS = {
+    "reference": 2.5,
+    "follow_up_opener": 2.0,
+    "trailing_ne": 1.5,
+    "short": 2.0,
+    "question_word": -0.5,
+    "long": -1.0,
+    "stock": -1.5,
+}
+
+
+class IntentRouter:
+    """
+    Local, rule based check in front of the rephrase chain. Commands, quick-reply
+    digits, stock codes / names and self-contained questions skip the gpt-4o-mini
+    round trip; only messages that look like they lean on the history are rephrased.
+    Messages that only might ("unsure", scoring between 0 and ``min_score``) are
+    answered as they are, the rephrase call costs a round trip on every message.
+    """
+
+    def __init__(self, stock_names=None, min_score=0.0) -> None:
+        self.min_score = min_score
+        # Names grouped by length: a lookup is one set probe per (position, length)
+        # of the message instead of a substring scan over every listed name
+        self.names_by_length = {}
+        for name in stock_names or []:
+            if name:
+                self.names_by_length.setdefault(len(name), set()).add(name)
+        self.name_lengths = sorted(self.names_by_length, reverse=True)
+        self.decisions = Counter()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_stock_list(cls, path=STOCK_LIST_PATH, min_score=0.0) -> "IntentRouter":
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                stock_names = list(json.load(file))
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to load stock list {path}: {e}")
+            stock_names = []
+        return cls(stock_names, min_score)
+
+    def route(self, msg, history) -> str:
+        """Return the decision for a message, "rephrase" means it needs the rephrase chain."""
+        text = msg.strip()
+        if not history:
+            decision = "no_history"
+        elif text.startswith("@"):
+            decision = "command"
+        elif text.isdigit() and len(text) <= 2:
+            decision = "quick_reply"
+        else:
+            decision = self.classify(text)
+        with self._lock:
+            self.decisions[decision] += 1
+        logger.info(f"Intent router: {decision} for {text[:50]!r}")
+        return decision
+
+    def classify(self, text) -> str:
+        # Features are computed once, the stock lookup is the expensive one
+        features = self.features(text)
+        score = self.score(text, features)
+        if score > self.min_score:
+            decision = "rephrase"
+        elif score > 0:
+            decision = "unsure"
+        elif features["stock"]:
+            # Names the stock itself, the message carries its own subject
+            decision = "stock"
+        else:
+            decision = "self_contained"
+        return decision
+
+    def needs_rephrase(self, msg, history) -> bool:
+        return self.route(msg, history) == "rephrase"
+
+    def mentions_stock(self, text) -> bool:
+        for length in self.name_lengths:
+            names = self.names_by_length[length]
+            for start in range(len(text) - length + 1):
+                if text[start:start + length] in names:
+                    return True
+        return False
+
+    def features(self, text) -> dict:
+        lowered = text.lower()
+        return {
+            "reference": any(word in text for word in REFERENCE_WORDS)
+            or bool(ENGLISH_REFERENCES.search(text)),
+            "follow_up_opener": lowered.startswith(FOLLOW_UP_OPENERS),
+            "trailing_ne": text.rstrip("?？ ").endswith("呢"),
+            "short": len(text) < 6,
+            "question_word": any(word in lowered for word in QUESTION_WORDS),
+            "long": len(text) >= 20,
+            "stock": bool(STOCK_CODE.search(text)) or self.mentions_stock(text),
+        }
+
+    def score(self, text, features=None) -> float:
+        """Log-odds that the message depends on the conversation history."""
+        if features is None:
+            features = self.features(text)
+        return BIAS + sum(WEIGHTS[name] for name, on in features.items() if on)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = sum(self.decisions.values())
+            stats = dict(self.decisions)
+        stats["total"] = total
+        stats["skip_rate"] = 1 - stats.get("rephrase", 0) / total if total else 0.0
+        return stats
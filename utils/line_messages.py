@@ -0,0 +1,44 @@
+from linebot.models import MessageAction, QuickReply, QuickReplyButton, TextSendMessage # type: ignore
+
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+# regular response
+question_response = "選擇一個問題編號來獲取更多信息"
+error_response = "處理您的請求時發生錯誤，請稍後再試。"
+
+
+def create_quick_reply_buttons(questions):
+    buttons = []
+    logger.info(questions)
+    for index, question in enumerate(
+        questions[:10], start=1
+    ):  # Limit to first 10 questions
+        label = f"{index}"
+        buttons.append(
+            QuickReplyButton(action=MessageAction(label=label, text=str(index))) # type: ignore
+        )
+    return buttons
+
+
+def push_target(event):
+    """Where push messages for an event go: the group or room, otherwise the user."""
+    source = event.source
+    return getattr(source, "group_id", None) or getattr(source, "room_id", None) or source.user_id
+
+
+def follow_up_messages(sessions, user_id, questions):
+    """Messages listing the follow-up questions, with quick replies to pick one."""
+    if not questions:
+        return [TextSendMessage(text="請提供更詳細的問題")] # type: ignore
+    last_questions = questions.split("\n")
+    sessions.update(user_id, last_questions=last_questions)
+    quick_reply_buttons = create_quick_reply_buttons(last_questions)
+    return [
+        TextSendMessage(text=f"以下是後續問題：\n{questions}"), # type: ignore
+        TextSendMessage( # type: ignore
+            text=question_response,
+            quick_reply=QuickReply(items=quick_reply_buttons), # type: ignore
+        ),
+    ]
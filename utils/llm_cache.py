@@ -0,0 +1,76 @@
+import hashlib
+import json
+import threading
+
+import redis # type: ignore
+
+from utils.logger import setup_logger
+from utils.lru_cache import TTLCache
+
+logger = setup_logger()
+
+
+class LLMResponseCache:
+    """
+    Exact-match cache of LLM responses keyed by model, prompt template, history and input.
+    The in-process LRU is checked first, then Redis when a URL is given.
+    """
+
+    def __init__(self, maxsize=2048, ttl=60 * 60, redis_url=None, prefix="llm_cache:") -> None:
+        self.ttl = ttl
+        self.prefix = prefix
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl, sliding=False)
+        self.redis = redis.Redis.from_url(redis_url) if redis_url else None
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model, template, history, text) -> str:
+        payload = json.dumps([model, template, history, text], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return the cached response or None."""
+        value = self.local.get(key)
+        if value is not None:
+            self._count("hits")
+            return value
+        if self.redis is not None:
+            try:
+                raw = self.redis.get(self.prefix + key)
+            except redis.RedisError as e:
+                logger.error(f"LLM cache read failed: {e}")
+                raw = None
+            if raw is not None:
+                value = raw.decode("utf-8")
+                self.local.set(key, value)
+                self._count("redis_hits")
+                return value
+        self._count("misses")
+        return None
+
+    def set(self, key, value) -> None:
+        self.local.set(key, value)
+        if self.redis is None:
+            return
+        try:
+            self.redis.set(self.prefix + key, value, ex=self.ttl)
+        except redis.RedisError as e:
+            logger.error(f"LLM cache write failed: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.redis_hits + self.misses
+            return {
+                "hits": self.hits,
+                "redis_hits": self.redis_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.redis_hits) / lookups if lookups else 0.0,
+                "size": len(self.local),
+            }
+
+    def _count(self, name) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
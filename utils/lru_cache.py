@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire after ``ttl`` seconds.
+    With ``sliding`` the TTL restarts on every read, i.e. it is an idle timeout.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, sliding=True, on_evict=None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sliding = sliding
+        # Called with (key, value) when an entry is dropped for size or age
+        self.on_evict = on_evict
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        """Return the value for ``key`` and mark it as recently used."""
+        evicted = None
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                evicted = (key, value)
+            else:
+                self._data.move_to_end(key)
+                if self.sliding and self.ttl is not None:
+                    self._data[key] = (value, time.monotonic() + self.ttl)
+        if evicted:
+            self._evicted([evicted])
+            return default
+        return value
+
+    def set(self, key, value, ttl=None) -> None:
+        """Store ``value``, evicting the least recently used entries past ``maxsize``."""
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        evicted = []
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                old_key, (old_value, _) = self._data.popitem(last=False)
+                evicted.append((old_key, old_value))
+        self._evicted(evicted)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def expire(self) -> int:
+        """Drop every expired entry, return how many were dropped."""
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            for key, (value, expires_at) in list(self._data.items()):
+                if expires_at is not None and expires_at <= now:
+                    del self._data[key]
+                    evicted.append((key, value))
+        self._evicted(evicted)
+        return len(evicted)
+
+    def _evicted(self, entries) -> None:
+        if not self.on_evict:
+            return
+        for key, value in entries:
+            self.on_evict(key, value)
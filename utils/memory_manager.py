@@ -0,0 +1,209 @@
+import json
+import uuid
+from typing import Any, List
+
+import redis # type: ignore
+from langchain.memory import ConversationBufferWindowMemory # type: ignore
+from langchain_core.messages import messages_from_dict, messages_to_dict # type: ignore
+
+from utils.logger import setup_logger
+from utils.lru_cache import TTLCache
+
+logger = setup_logger()
+
+
+class ConversationMemory(ConversationBufferWindowMemory):
+    """
+    Window memory of one conversation that also numbers its turns, so each stored
+    chat turn can say which earlier turns and which summary its prompt saw.
+    With a HistoryCompactor the history is a rolling summary plus recent turns.
+    """
+
+    conversation_id: str = ""
+    # Number of turns saved so far, the next turn is seq + 1
+    seq: int = 0
+    # First turn that is not folded into the summary
+    first_seq: int = 1
+    summary: str = ""
+    summary_version: int = 0
+    # Turns out of the window that are not in the summary yet
+    pending: List[Any] = []
+    summarizing: bool = False
+    compactor: Any = None
+    # Called after the summary changed, e.g. to persist the memory
+    on_compacted: Any = None
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        if not self.conversation_id:
+            self.conversation_id = str(uuid.uuid4())
+
+    def load_memory_variables(self, inputs) -> dict:
+        if self.compactor is None:
+            return super().load_memory_variables(inputs)
+        return {
+            self.memory_key: self.compactor.render(
+                self.summary, self.pending, self.chat_memory.messages
+            )
+        }
+
+    def save_context(self, inputs, outputs) -> None:
+        super().save_context(inputs, outputs)
+        self.seq += 1
+        if self.compactor is not None:
+            self.compactor.compact(self)
+
+    def begin_turn(self) -> dict:
+        """
+        Describe the history the next turn's prompt is built from: its sequence number,
+        the first earlier turn included and the summary version. The summary text goes
+        with every turn that references a version, so the version is stored even if the
+        turn that first saw it never is (the insert ignores versions already stored).
+        """
+        seq = self.seq + 1
+        if self.compactor is None:
+            window_start = max(1, seq - self.k)
+        else:
+            window_start = self.first_seq
+        turn = {
+            "conversation_id": self.conversation_id,
+            "seq": seq,
+            "window_start": window_start,
+            "summary_version": self.summary_version,
+            "summary": self.summary if self.summary_version else None,
+        }
+        return turn
+
+    def clear(self) -> None:
+        super().clear()
+        # A cleared memory starts a new conversation
+        self.conversation_id = str(uuid.uuid4())
+        self.seq = 0
+        self.first_seq = 1
+        self.summary = ""
+        self.summary_version = 0
+        self.pending = []
+
+
+# Serialized next to the messages in Redis
+STATE_FIELDS = (
+    "conversation_id", "seq", "first_seq", "summary", "summary_version",
+)
+
+
+class MemoryManager:
+    """
+    One conversation memory per user instead of a single memory shared by everyone.
+    Memories live in a size-bounded LRU and are dropped after ``ttl`` idle seconds;
+    when a Redis URL is given they are also serialized there after every turn.
+    With a HistoryCompactor the memories keep a rolling summary instead of a raw window.
+    """
+
+    def __init__(
+        self, k=5, maxsize=1000, ttl=60 * 60, redis_url=None, local_ttl=5, prefix="memory:",
+        compactor=None,
+    ) -> None:
+        self.k = compactor.recent_turns if compactor else k
+        self.compactor = compactor
+        self.ttl = ttl
+        self.prefix = prefix
+        self.redis = redis.Redis.from_url(redis_url) if redis_url else None
+        if self.redis is not None:
+            self.local = TTLCache(maxsize=maxsize, ttl=local_ttl, sliding=False)
+        else:
+            self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def new_memory(self, user_id) -> ConversationMemory:
+        memory = ConversationMemory(k=self.k, compactor=self.compactor)
+        # Persist the summary once the background summarization lands
+        memory.on_compacted = lambda: self.save(user_id, memory, only_if_current=True)
+        return memory
+
+    def get(self, user_id) -> ConversationMemory:
+        """Return the memory of a user, creating an empty one if needed."""
+        memory = self.local.get(user_id)
+        if memory is not None:
+            return memory
+        memory = self._load(user_id) or self.new_memory(user_id)
+        self.local.set(user_id, memory)
+        return memory
+
+    def save(self, user_id, memory, only_if_current=False) -> None:
+        """
+        Write a memory back after a turn. Takes the memory object itself: with Redis
+        the local copy lives only a few seconds and is usually gone after an LLM call.
+        With ``only_if_current`` it is not written over a newer turn or conversation
+        saved meanwhile, e.g. by a background summary of a memory since reloaded, nor
+        over a memory cleared meanwhile.
+        """
+        if not only_if_current:
+            self.local.set(user_id, memory)
+        if self.redis is None:
+            return
+        # Only the window is ever read back, don't ship older messages around
+        data = {
+            "messages": messages_to_dict(memory.chat_memory.messages[-2 * self.k:]),
+            "pending": messages_to_dict(memory.pending),
+        }
+        for field in STATE_FIELDS:
+            data[field] = getattr(memory, field)
+        raw = json.dumps(data, ensure_ascii=False)
+        key = self.prefix + user_id
+        try:
+            if not only_if_current:
+                self.redis.set(key, raw, ex=self.ttl)
+                return
+            with self.redis.pipeline() as pipe:
+                pipe.watch(key)
+                stored = pipe.get(key)
+                if not stored:
+                    # Cleared or expired, writing it back would revive the conversation
+                    logger.info(f"Not saving a memory of {user_id} that is no longer stored")
+                    return
+                stored = json.loads(stored)
+                if isinstance(stored, dict) and (
+                    stored.get("conversation_id") != memory.conversation_id
+                    or stored.get("seq", 0) > memory.seq
+                ):
+                    logger.info(f"Not saving a stale memory of {user_id}")
+                    return
+                pipe.multi()
+                pipe.set(key, raw, ex=self.ttl)
+                pipe.execute()
+        except redis.WatchError:
+            logger.info(f"Memory of {user_id} changed while saving, keeping the newer one")
+        except redis.RedisError as e:
+            logger.error(f"Failed to save memory of {user_id} to Redis: {e}")
+
+    def clear(self, user_id) -> None:
+        memory = self.local.pop(user_id)
+        if memory is not None:
+            memory.clear()
+        if self.redis is None:
+            return
+        try:
+            self.redis.delete(self.prefix + user_id)
+        except redis.RedisError as e:
+            logger.error(f"Failed to clear memory of {user_id} in Redis: {e}")
+
+    def _load(self, user_id):
+        if self.redis is None:
+            return None
+        try:
+            raw = self.redis.get(self.prefix + user_id)
+        except redis.RedisError as e:
+            logger.error(f"Failed to load memory of {user_id} from Redis: {e}")
+            return None
+        if not raw:
+            return None
+        data = json.loads(raw)
+        if isinstance(data, list):
+            # Written before the summary was kept alongside the messages
+            data = {"messages": data}
+        memory = self.new_memory(user_id)
+        memory.chat_memory.messages = messages_from_dict(data.get("messages", []))
+        memory.pending = messages_from_dict(data.get("pending", []))
+        for field in STATE_FIELDS:
+            if field in data:
+                setattr(memory, field, data[field])
+        return memory
@@ -0,0 +1,102 @@
+"""
+Backfill chat_turns from the legacy chat_history table, which stored the whole
+history window as JSON on every row.
+
+    python -m utils.migrate_chat_history [--batch-size 1000] [--window 5]
+
+Rows are streamed through a server-side cursor in (user_id, timestamp) order and
+written in batches. Every user becomes one conversation whose id is derived from
+the user id, so the backfill can be re-run safely.
+"""
+import argparse
+import uuid
+
+from psycopg2.extras import execute_values # type: ignore
+
+from utils.db import connection
+from utils.logger import setup_logger
+from utils.schema import migrate
+
+logger = setup_logger()
+
+# Namespace for the conversation ids of backfilled users
+LEGACY_NAMESPACE = uuid.UUID("6f1c0f5e-7d55-4f0e-9a51-3c1f6a0b2e11")
+
+
+def legacy_rows(conn, batch_size):
+    with conn.cursor(name="legacy_chat_history") as cur:
+        cur.itersize = batch_size
+        cur.execute(
+            """
+            SELECT user_id, user_msg, rephrase_msg, image, response, timestamp
+            FROM chat_history
+            ORDER BY user_id, timestamp, id
+            """
+        )
+        yield from cur
+
+
+def backfill(batch_size=1000, window=5) -> int:
+    with connection() as conn:
+        migrate(conn)
+
+    migrated = 0
+    # One connection reads, the other writes and commits per batch, so the
+    # server-side cursor's transaction is never committed under it
+    with connection() as read_conn, connection() as write_conn:
+        batch = []
+        current_user, seq = None, 0
+        for user_id, user_msg, rephrase_msg, image, response, timestamp in legacy_rows(
+            read_conn, batch_size
+        ):
+            if user_id != current_user:
+                current_user, seq = user_id, 0
+            seq += 1
+            batch.append(
+                (
+                    str(uuid.uuid5(LEGACY_NAMESPACE, str(user_id))),
+                    seq,
+                    user_id,
+                    user_msg,
+                    rephrase_msg,
+                    image,
+                    response,
+                    # The legacy rows saw a raw window of the last turns, no summary
+                    max(1, seq - window),
+                    0,
+                    timestamp,
+                )
+            )
+            if len(batch) >= batch_size:
+                migrated += write_batch(write_conn, batch)
+                batch = []
+        if batch:
+            migrated += write_batch(write_conn, batch)
+    return migrated
+
+
+def write_batch(conn, batch) -> int:
+    with conn.cursor() as cur:
+        execute_values(
+            cur,
+            """
+            INSERT INTO chat_turns (conversation_id, seq, user_id, user_msg, rephrase_msg, image,
+                                    response, window_start, summary_version, timestamp)
+            VALUES %s
+            ON CONFLICT (conversation_id, seq) DO NOTHING
+            """,
+            batch,
+            page_size=len(batch),
+        )
+    conn.commit()
+    logger.info(f"Backfilled {len(batch)} chat turns")
+    return len(batch)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--window", type=int, default=5, help="turns in the legacy history window")
+    args = parser.parse_args()
+    total = backfill(batch_size=args.batch_size, window=args.window)
+    logger.info(f"Migrated {total} chat_history rows to chat_turns")
@@ -0,0 +1,267 @@
+"""
+Managed PostgreSQL schema: ordered migrations recorded in schema_migrations, plus
+the optional monthly range partitioning of ``articles``.
+
+    python -m utils.schema migrate
+    python -m utils.schema partition                 # convert articles to monthly partitions
+    python -m utils.schema maintain [--months-ahead 2] [--retention-months 12]
+"""
+import argparse
+from datetime import date
+
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+ARTICLES_TABLE = """
+    CREATE TABLE IF NOT EXISTS articles (
+        id SERIAL PRIMARY KEY,
+        stock_id INTEGER NOT NULL,
+        title TEXT,
+        date TIMESTAMP,
+        url TEXT UNIQUE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        content TEXT
+    )
+"""
+
+# Serves the hot "articles of a stock in the last N days, newest first" query
+ARTICLES_STOCK_DATE_INDEX = """
+    CREATE INDEX IF NOT EXISTS articles_stock_id_date_idx
+        ON articles (stock_id, date DESC)
+"""
+
+# One row per chat turn. window_start and summary_version describe the history the
+# turn's prompt saw: the summary of that version plus turns window_start..seq-1.
+CHAT_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS chat_turns (
+        id BIGSERIAL PRIMARY KEY,
+        conversation_id UUID NOT NULL,
+        seq INTEGER NOT NULL,
+        user_id TEXT NOT NULL,
+        user_msg TEXT,
+        rephrase_msg TEXT,
+        image TEXT,
+        response TEXT,
+        window_start INTEGER NOT NULL,
+        summary_version INTEGER NOT NULL DEFAULT 0,
+        timestamp TIMESTAMP NOT NULL,
+        UNIQUE (conversation_id, seq)
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS chat_turns_user_id_timestamp_idx
+        ON chat_turns (user_id, timestamp DESC)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS chat_summaries (
+        conversation_id UUID NOT NULL,
+        version INTEGER NOT NULL,
+        summary TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (conversation_id, version)
+    )
+    """,
+]
+
+# Applied in order, each once. Never edit an applied migration, add a new one.
+MIGRATIONS = [
+    ("001_create_articles", [ARTICLES_TABLE]),
+    ("002_articles_stock_id_date_idx", [ARTICLES_STOCK_DATE_INDEX]),
+    ("003_chat_turns", CHAT_SCHEMA),
+]
+
+
+def migrate(conn) -> list:
+    """Apply the pending migrations, each in its own transaction. Returns their names."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                name TEXT PRIMARY KEY,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        cur.execute("SELECT name FROM schema_migrations")
+        applied = {row[0] for row in cur.fetchall()}
+    conn.commit()
+
+    done = []
+    for name, statements in MIGRATIONS:
+        if name in applied:
+            continue
+        with conn.cursor() as cur:
+            for statement in statements:
+                cur.execute(statement)
+            cur.execute("INSERT INTO schema_migrations (name) VALUES (%s)", (name,))
+        conn.commit()
+        logger.info(f"Applied migration {name}")
+        done.append(name)
+    return done
+
+
+def _month_start(day, offset=0) -> date:
+    month = day.year * 12 + day.month - 1 + offset
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def _partition_name(month) -> str:
+    return f"articles_y{month.year}m{month.month:02d}"
+
+
+def is_partitioned(conn) -> bool:
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'articles'::regclass"
+        )
+        return cur.fetchone() is not None
+
+
+def partition_articles(conn, months_ahead=2) -> None:
+    """
+    Convert ``articles`` into a table range-partitioned by month on ``date``.
+    Postgres requires unique keys to contain the partition key, so url is unique per
+    (url, date) afterwards; an article's date never changes, so duplicates are still
+    rejected. A primary key would make date NOT NULL, so (id, date) is a unique key
+    instead and rows without a date are copied into the default partition.
+    Run it once, during a quiet period: it copies the whole table.
+    """
+    if is_partitioned(conn):
+        logger.info("articles is already partitioned")
+        return
+    with conn.cursor() as cur:
+        cur.execute("SELECT MIN(date) FROM articles")
+        oldest = cur.fetchone()[0] or date.today()
+        cur.execute("ALTER TABLE articles RENAME TO articles_unpartitioned")
+        # Constraint indexes share the relation namespace, free the names for the new table
+        cur.execute("ALTER TABLE articles_unpartitioned RENAME CONSTRAINT articles_pkey TO articles_unpartitioned_pkey")
+        cur.execute("ALTER TABLE articles_unpartitioned RENAME CONSTRAINT articles_url_key TO articles_unpartitioned_url_key")
+        cur.execute("ALTER INDEX IF EXISTS articles_stock_id_date_idx RENAME TO articles_unpartitioned_stock_id_date_idx")
+        cur.execute(
+            """
+            CREATE TABLE articles (
+                id INTEGER NOT NULL DEFAULT nextval('articles_id_seq'),
+                stock_id INTEGER NOT NULL,
+                title TEXT,
+                date TIMESTAMP,
+                url TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                content TEXT,
+                UNIQUE (id, date),
+                UNIQUE (url, date)
+            ) PARTITION BY RANGE (date)
+            """
+        )
+        cur.execute("ALTER SEQUENCE articles_id_seq OWNED BY articles.id")
+        # Rows without a date, or outside every monthly partition
+        cur.execute("CREATE TABLE articles_default PARTITION OF articles DEFAULT")
+        cur.execute(ARTICLES_STOCK_DATE_INDEX)
+    create_partitions(conn, _month_start(oldest), _month_start(date.today(), months_ahead))
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO articles (id, stock_id, title, date, url, created_at, content)
+            SELECT id, stock_id, title, date, url, created_at, content
+            FROM articles_unpartitioned
+            """
+        )
+        cur.execute("DROP TABLE articles_unpartitioned")
+    conn.commit()
+    logger.info("articles is now partitioned by month")
+
+
+def create_partitions(conn, first_month, last_month) -> None:
+    """
+    Create the monthly partitions from first_month to last_month, both included. Does not commit.
+    Postgres refuses a partition whose rows already sit in the default partition, so
+    those are moved out first and inserted again once the partition exists.
+    """
+    month = first_month
+    with conn.cursor() as cur:
+        while month <= last_month:
+            following = _month_start(month, 1)
+            name = _partition_name(month)
+            cur.execute("SELECT to_regclass(%s)", (name,))
+            if cur.fetchone()[0] is None:
+                # No inserts of the month may land in the default partition meanwhile
+                cur.execute("LOCK TABLE articles_default IN SHARE ROW EXCLUSIVE MODE")
+                cur.execute("CREATE TEMP TABLE articles_moving (LIKE articles)")
+                cur.execute(
+                    """
+                    WITH moved AS (
+                        DELETE FROM articles_default WHERE date >= %s AND date < %s RETURNING *
+                    )
+                    INSERT INTO articles_moving SELECT * FROM moved
+                    """,
+                    (month, following),
+                )
+                if cur.rowcount:
+                    logger.info(f"Moving {cur.rowcount} articles from the default partition to {name}")
+                cur.execute(
+                    f"""
+                    CREATE TABLE {name} PARTITION OF articles
+                    FOR VALUES FROM ('{month.isoformat()}') TO ('{following.isoformat()}')
+                    """
+                )
+                cur.execute("INSERT INTO articles SELECT * FROM articles_moving")
+                cur.execute("DROP TABLE articles_moving")
+            month = following
+
+
+def drop_expired_partitions(conn, retention_months) -> list:
+    """Drop the monthly partitions that end before the retention window starts."""
+    cutoff = _month_start(date.today(), -retention_months)
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT child.relname
+            FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE parent.relname = 'articles' AND child.relname ~ '^articles_y[0-9]{4}m[0-9]{2}$'
+            """
+        )
+        dropped = []
+        for (name,) in cur.fetchall():
+            month = date(int(name[10:14]), int(name[15:17]), 1)
+            if _month_start(month, 1) <= cutoff:
+                cur.execute(f"DROP TABLE {name}")
+                dropped.append(name)
+    conn.commit()
+    for name in dropped:
+        logger.info(f"Dropped expired partition {name}")
+    return dropped
+
+
+def maintain_partitions(conn, months_ahead=2, retention_months=None) -> None:
+    """Create the coming months' partitions and prune old ones, a no-op when not partitioned."""
+    if not is_partitioned(conn):
+        return
+    today = date.today()
+    create_partitions(conn, _month_start(today), _month_start(today, months_ahead))
+    conn.commit()
+    if retention_months:
+        drop_expired_partitions(conn, retention_months)
+
+
+if __name__ == "__main__":
+    from config import Config
+    from utils.db import connection
+
+    parser = argparse.ArgumentParser(description="Manage the PostgreSQL schema")
+    parser.add_argument("command", choices=["migrate", "partition", "maintain"])
+    parser.add_argument("--months-ahead", type=int, default=2)
+    parser.add_argument("--retention-months", type=int, default=Config.ARTICLES_RETENTION_MONTHS)
+    args = parser.parse_args()
+
+    with connection() as conn:
+        if args.command == "migrate":
+            applied = migrate(conn)
+            logger.info(f"Applied {len(applied)} migrations")
+        elif args.command == "partition":
+            migrate(conn)
+            partition_articles(conn, args.months_ahead)
+        else:
+            maintain_partitions(conn, args.months_ahead, args.retention_months)
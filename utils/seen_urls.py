@@ -0,0 +1,120 @@
+"""
+Bloom filter of the stored article URLs, shared by the crawl processes through Redis.
+
+    python -m utils.seen_urls warm    # load articles.url into a new filter, once per filter
+"""
+import argparse
+import hashlib
+import math
+
+import redis # type: ignore
+
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+
+class SeenUrlFilter:
+    """
+    Bloom filter of the article URLs already stored, kept in a Redis bitmap so every
+    crawl process shares it. Sized for ``capacity`` URLs at ``error_rate`` false
+    positives: a false positive skips a new article, a miss only costs a download
+    that ON CONFLICT then discards. Changing the sizing starts a new, empty filter.
+    """
+
+    def __init__(self, redis_client, capacity=1_000_000, error_rate=0.001, prefix="articles:seen_urls") -> None:
+        self.redis = redis_client
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.key = f"{prefix}:{self.size}:{self.hashes}"
+        self.warmed_key = self.key + ":warmed"
+
+    def _offsets(self, url) -> list:
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.sha256(url.encode("utf-8")).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def contains_many(self, urls) -> list:
+        """One bool per URL, in one round trip. Everything counts as unseen if Redis fails."""
+        urls = list(urls)
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for url in urls:
+                for offset in self._offsets(url):
+                    pipe.getbit(self.key, offset)
+            bits = pipe.execute()
+        except redis.RedisError as e:
+            logger.error(f"Seen URL lookup failed: {e}")
+            return [False] * len(urls)
+        return [
+            all(bits[i * self.hashes:(i + 1) * self.hashes]) for i in range(len(urls))
+        ]
+
+    def contains(self, url) -> bool:
+        return self.contains_many([url])[0]
+
+    def add(self, *urls) -> None:
+        if not urls:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for url in urls:
+                for offset in self._offsets(url):
+                    pipe.setbit(self.key, offset, 1)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.error(f"Failed to add {len(urls)} URLs to the seen filter: {e}")
+
+    def warm(self, conn, batch_size=5000) -> int:
+        """
+        Load articles.url into the filter once per filter, later calls return 0.
+        Returns the number of URLs loaded.
+        """
+        if not self.redis.set(self.warmed_key, 1, nx=True):
+            return 0
+        loaded = 0
+        try:
+            with conn.cursor(name="warm_seen_urls") as cur:
+                cur.itersize = batch_size
+                cur.execute("SELECT url FROM articles WHERE url IS NOT NULL")
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    self.add(*(url for (url,) in rows))
+                    loaded += len(rows)
+            conn.commit()
+        except Exception:
+            # Let the next crawl retry the warm-up
+            self.redis.delete(self.warmed_key)
+            raise
+        logger.info(f"Warmed the seen URL filter with {loaded} URLs")
+        return loaded
+
+
+if __name__ == "__main__":
+    import psycopg2 # type: ignore
+
+    from utils.db import connection
+    from yahoo_news import settings
+
+    parser = argparse.ArgumentParser(description="Manage the seen URL filter of the crawler")
+    parser.add_argument("command", choices=["warm"])
+    parser.parse_args()
+
+    if not settings.SEEN_URLS_ENABLED:
+        logger.info("The seen URL filter is disabled")
+    else:
+        seen_urls = SeenUrlFilter(
+            redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=0),
+            settings.SEEN_URLS_CAPACITY,
+            settings.SEEN_URLS_ERROR_RATE,
+        )
+        try:
+            with connection() as conn:
+                seen_urls.warm(conn)
+        except (psycopg2.Error, redis.RedisError) as e:
+            # Don't fail the release, without the warm-up the filter only misses
+            logger.error(f"Failed to warm the seen URL filter: {e}")
@@ -0,0 +1,93 @@
+import hashlib
+import threading
+import time
+
+import numpy as np # type: ignore
+
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+
+class HashingEmbeddings:
+    """
+    Offline stand-in for an embedding model: character n-grams hashed into a fixed
+    number of buckets. Deterministic and dependency free, for tests and local runs.
+    """
+
+    def __init__(self, dim=256, ngram=2) -> None:
+        self.dim = dim
+        self.ngram = ngram
+
+    def embed_query(self, text) -> list:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        text = "".join(text.lower().split())
+        for i in range(max(len(text) - self.ngram + 1, 1)):
+            gram = text[i:i + self.ngram].encode("utf-8")
+            vector[int(hashlib.md5(gram).hexdigest(), 16) % self.dim] += 1.0
+        return vector.tolist()
+
+
+class SemanticCache:
+    """
+    Answers of earlier questions indexed by the embedding of the question.
+    A lookup returns the answer of the most similar stored question when the cosine
+    similarity reaches ``threshold``. Entries expire after ``ttl`` seconds and the
+    least recently used entry is replaced once ``maxsize`` entries are stored.
+    """
+
+    def __init__(self, embeddings, threshold=0.92, maxsize=1000, ttl=30 * 60) -> None:
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Allocated on the first add, once the embedding size is known
+        self.vectors = None
+        self.expires_at = np.zeros(maxsize)
+        self.last_used = np.zeros(maxsize)
+        self.answers = [None] * maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def embed(self, text):
+        vector = np.asarray(self.embeddings.embed_query(text), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def search(self, vector):
+        """Return the cached answer closest to ``vector``, None below the threshold."""
+        with self._lock:
+            if self.vectors is None:
+                self.misses += 1
+                return None
+            now = time.time()
+            # Expired and empty slots have expires_at <= now and never match
+            scores = self.vectors @ vector
+            scores[self.expires_at <= now] = -1.0
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.last_used[best] = now
+            self.hits += 1
+            logger.info(f"Semantic cache hit, similarity {scores[best]:.3f}")
+            return self.answers[best]
+
+    def add(self, vector, answer) -> None:
+        with self._lock:
+            if self.vectors is None:
+                self.vectors = np.zeros((self.maxsize, vector.shape[0]), dtype=np.float32)
+            now = time.time()
+            free = np.flatnonzero(self.expires_at <= now)
+            # Reuse an empty or expired slot, otherwise evict the least recently used
+            slot = int(free[0]) if free.size else int(np.argmin(self.last_used))
+            self.vectors[slot] = vector
+            self.expires_at[slot] = now + self.ttl
+            self.last_used[slot] = now
+            self.answers[slot] = answer
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = int(np.count_nonzero(self.expires_at > time.time()))
+            return {"hits": self.hits, "misses": self.misses, "size": size}
@@ -0,0 +1,76 @@
+import json
+
+import redis # type: ignore
+
+from utils.logger import setup_logger
+from utils.lru_cache import TTLCache
+
+logger = setup_logger()
+
+
+class SessionStore:
+    """
+    Per-user session state (chat mode, last follow-up questions, ...).
+    Sessions live in a bounded in-process LRU; when a Redis URL is given they are
+    also written through to a Redis hash per user so every gunicorn worker sees them.
+    """
+
+    def __init__(
+        self, redis_url=None, maxsize=10000, ttl=24 * 60 * 60, local_ttl=5, prefix="session:"
+    ) -> None:
+        self.ttl = ttl
+        self.prefix = prefix
+        self.redis = redis.Redis.from_url(redis_url) if redis_url else None
+        if self.redis is not None:
+            # Redis is the source of truth, keep local copies short-lived so other
+            # workers' writes become visible quickly
+            self.local = TTLCache(maxsize=maxsize, ttl=local_ttl, sliding=False)
+        else:
+            self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, user_id) -> dict:
+        """Return the whole session of a user, an empty dict if there is none."""
+        session = self.local.get(user_id)
+        if session is not None:
+            return session
+        session = self._load(user_id)
+        self.local.set(user_id, session)
+        return session
+
+    def get_field(self, user_id, field, default=None):
+        return self.get(user_id).get(field, default)
+
+    def update(self, user_id, **fields) -> None:
+        """Set some fields of a user's session."""
+        session = dict(self.get(user_id))
+        session.update(fields)
+        self.local.set(user_id, session)
+        if self.redis is None:
+            return
+        try:
+            key = self.prefix + user_id
+            pipe = self.redis.pipeline()
+            pipe.hset(key, mapping={k: json.dumps(v, ensure_ascii=False) for k, v in fields.items()})
+            pipe.expire(key, self.ttl)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.error(f"Failed to write session of {user_id} to Redis: {e}")
+
+    def clear(self, user_id) -> None:
+        self.local.pop(user_id)
+        if self.redis is None:
+            return
+        try:
+            self.redis.delete(self.prefix + user_id)
+        except redis.RedisError as e:
+            logger.error(f"Failed to clear session of {user_id} in Redis: {e}")
+
+    def _load(self, user_id) -> dict:
+        if self.redis is None:
+            return {}
+        try:
+            raw = self.redis.hgetall(self.prefix + user_id)
+        except redis.RedisError as e:
+            logger.error(f"Failed to read session of {user_id} from Redis: {e}")
+            return {}
+        return {k.decode(): json.loads(v) for k, v in raw.items()}
@@ -0,0 +1,112 @@
+import weakref
+
+from utils.db import connection
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+ARTICLE_COLUMNS = ("id", "stock_id", "title", "content", "url", "date", "created_at")
+# Everything but the article body, enough to list articles
+SUMMARY_COLUMNS = ("id", "title", "url", "date")
+
+# Prepared statement names per connection, prepared statements live as long as the session
+_prepared = weakref.WeakKeyDictionary()
+
+
+def _check_columns(columns) -> tuple:
+    columns = tuple(columns)
+    unknown = set(columns) - set(ARTICLE_COLUMNS)
+    if unknown or not columns:
+        raise ValueError(f"Unknown article columns: {sorted(unknown)}")
+    return columns
+
+
+def _execute_prepared(cur, name, sql, params) -> None:
+    """Run sql ($1, $2... placeholders) as a named prepared statement of this connection."""
+    prepared = _prepared.setdefault(cur.connection, set())
+    if name not in prepared:
+        cur.execute(f"PREPARE {name} AS {sql}")
+        prepared.add(name)
+    placeholders = ", ".join(["%s"] * len(params))
+    cur.execute(f"EXECUTE {name} ({placeholders})", params)
+
+
+def count_recent_articles(stock_id, days=30) -> int:
+    """Number of articles about a stock published in the last ``days`` days."""
+    with connection() as conn:
+        with conn.cursor() as cur:
+            _execute_prepared(
+                cur,
+                "count_recent_articles",
+                """
+                SELECT COUNT(*) FROM articles
+                WHERE stock_id = $1 AND date >= NOW() - make_interval(days => $2)
+                """,
+                (int(stock_id), int(days)),
+            )
+            return cur.fetchone()[0]
+
+
+def list_recent_articles(stock_id, days=30, columns=SUMMARY_COLUMNS, limit=None) -> list:
+    """Recent articles of a stock, newest first, as dicts holding only ``columns``."""
+    columns = _check_columns(columns)
+    with connection() as conn:
+        with conn.cursor() as cur:
+            _execute_prepared(
+                cur,
+                "list_recent_articles_" + "_".join(columns),
+                f"""
+                SELECT {", ".join(columns)} FROM articles
+                WHERE stock_id = $1 AND date >= NOW() - make_interval(days => $2)
+                ORDER BY date DESC
+                LIMIT $3
+                """,
+                # LIMIT NULL means no limit
+                (int(stock_id), int(days), limit),
+            )
+            return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+def iter_recent_articles(stock_id, days=30, columns=ARTICLE_COLUMNS, batch_size=100):
+    """
+    Stream recent articles of a stock through a server-side cursor, ``batch_size``
+    rows per round trip, for consumers that need the full content.
+    """
+    columns = _check_columns(columns)
+    with connection() as conn:
+        with conn.cursor(name="iter_recent_articles") as cur:
+            cur.itersize = batch_size
+            cur.execute(
+                f"""
+                SELECT {", ".join(columns)} FROM articles
+                WHERE stock_id = %s AND date >= NOW() - make_interval(days => %s)
+                ORDER BY date DESC
+                """,
+                (int(stock_id), int(days)),
+            )
+            for row in cur:
+                yield dict(zip(columns, row))
+
+
+def list_articles_since(stock_id, since, columns=SUMMARY_COLUMNS) -> list:
+    """Articles of a stock stored at or after ``since`` (a database timestamp), newest first."""
+    columns = _check_columns(columns)
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""
+                SELECT {", ".join(columns)} FROM articles
+                WHERE stock_id = %s AND created_at >= %s
+                ORDER BY date DESC
+                """,
+                (int(stock_id), since),
+            )
+            return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+def database_now():
+    """Current timestamp as created_at defaults it, to compare against later."""
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT LOCALTIMESTAMP")
+            return cur.fetchone()[0]
@@ -0,0 +1,65 @@
+import re
+
+# LINE rejects text messages longer than this
+LINE_TEXT_LIMIT = 5000
+
+SENTENCE_END = re.compile(r"[。！？!?；;\n]|\.(?=\s)")
+
+
+class SentenceChunker:
+    """
+    Group streamed tokens into LINE-sized messages cut at sentence boundaries.
+    The first chunk is sent as soon as it holds ``first_size`` characters so the
+    user sees something quickly, later chunks wait for ``size`` characters to keep
+    the number of push messages down.
+    """
+
+    def __init__(self, first_size=60, size=1000, limit=LINE_TEXT_LIMIT) -> None:
+        self.first_size = first_size
+        self.size = size
+        self.limit = limit
+        self.buffer = ""
+        self.emitted = 0
+
+    def feed(self, text) -> list:
+        """Add streamed text, return the chunks that are ready to send."""
+        self.buffer += text
+        chunks = []
+        while True:
+            chunk = self._next_chunk()
+            if chunk is None:
+                return chunks
+            if chunk:
+                chunks.append(chunk)
+
+    def flush(self) -> list:
+        """Return whatever is left once the stream is done."""
+        chunks = []
+        while len(self.buffer) > self.limit:
+            chunks.append(self._cut(self._boundary(self.limit) or self.limit))
+        chunks.append(self._cut(len(self.buffer)))
+        return [chunk for chunk in chunks if chunk]
+
+    def _next_chunk(self):
+        threshold = self.first_size if self.emitted == 0 else self.size
+        if len(self.buffer) < threshold:
+            return None
+        if len(self.buffer) > self.limit:
+            # No room left, cut at the last sentence end or hard at the limit
+            return self._cut(self._boundary(self.limit) or self.limit)
+        end = self._boundary(len(self.buffer))
+        if end is None or end < threshold:
+            return None
+        return self._cut(end)
+
+    def _boundary(self, limit):
+        """Position right after the last sentence end within the first ``limit`` characters."""
+        end = None
+        for match in SENTENCE_END.finditer(self.buffer, 0, limit):
+            end = match.end()
+        return end
+
+    def _cut(self, end) -> str:
+        chunk, self.buffer = self.buffer[:end], self.buffer[end:]
+        self.emitted += 1
+        return chunk.strip()
@@ -2,7 +2,14 @@
 
 import os
 import logging
-from run_spiders import run_spiders
+from linebot import LineBotApi # type: ignore
+from run_spiders import get_crawl_service
+from config import Config
+from utils.crawl_coalescer import CrawlCoalescer
+from utils.crawl_notifier import CrawlNotifier, crawl_result_message
+from utils.db import connection
+from utils.schema import maintain_partitions
+from utils.stock_articles import count_recent_articles, database_now, list_articles_since
 
 
 # Import make_celery after appending project_root to sys.path
@@ -20,17 +27,73 @@ celery = make_celery(
     backend_url=os.environ.get('REDIS_URL')
 )
 
+# LLM tasks (chat, image, transcription), routed to their own queues by celery_config
+celery.conf.include = ['worker.llm_tasks']
+
+# Shared with the web app, which requests crawls through it
+crawl_coalescer = CrawlCoalescer(
+    Config.REDIS_URL,
+    freshness=Config.CRAWL_FRESHNESS,
+    lock_ttl=Config.CRAWL_LOCK_TTL,
+)
+
+# Users waiting on a crawl are pushed its result when it ends
+crawl_notifier = CrawlNotifier(
+    Config.REDIS_URL,
+    LineBotApi(Config.CHANNEL_ACCESS_TOKEN),
+    ttl=Config.CRAWL_LOCK_TTL,
+)
+
+# Keep next months' articles partitions ready and prune expired ones (the Procfile beat process)
+celery.conf.beat_schedule = {
+    'maintain-article-partitions': {
+        'task': 'worker.celery_worker.maintain_article_partitions',
+        'schedule': 24 * 60 * 60,
+    },
+}
+
 @celery.task(name='worker.celery_worker.fetch_stock_news', bind=True, max_retries=3, default_retry_delay=60)
 def fetch_stock_news(self, stock_id='2330'):
     """
     Celery task to execute Scrapy spiders for a given stock_id.
+    The crawl runs on the worker process' long-lived crawl service.
     Retries up to 3 times in case of failure, waiting 60 seconds between retries.
     """
     try:
-        run_spiders(stock_id=stock_id)
+        # Articles stored from now on are this crawl's
+        started = database_now()
+        get_crawl_service().submit(stock_id).result(timeout=Config.CRAWL_TIMEOUT)
         logging.info(f"Celery task completed for stock_id: {stock_id}")
-        return True
     except Exception as e:
         logging.error(f"Task failed for stock_id {stock_id}: {e}")
+        # Retries keep the lock, requests meanwhile still attach to this task
+        if self.request.retries >= self.max_retries:
+            crawl_coalescer.release(stock_id, self.request.id, failed=True)
+            crawl_notifier.notify(stock_id, f"無法取得 {stock_id} 的最新新聞，請稍後再試。")
         self.retry(exc=e)
-        return False
\ No newline at end of file
+        return False
+
+    # Release first: users asking from now on get the fresh count directly
+    crawl_coalescer.finish(stock_id, self.request.id)
+    try:
+        notify_crawl_result(stock_id, started)
+    except Exception as e:
+        # The crawl itself succeeded, don't retry it
+        logging.error(f"Failed to notify the crawl result of {stock_id}: {e}")
+    return True
+
+
+def notify_crawl_result(stock_id, started):
+    """Push the articles a crawl added to the users waiting on it."""
+    if not crawl_notifier.has_waiters(stock_id):
+        return
+    new_articles = list_articles_since(stock_id, started)
+    total = count_recent_articles(stock_id)
+    crawl_notifier.notify(stock_id, crawl_result_message(stock_id, new_articles, total))
+
+
+@celery.task(name='worker.celery_worker.maintain_article_partitions')
+def maintain_article_partitions():
+    """Create upcoming monthly articles partitions and drop the expired ones."""
+    with connection() as conn:
+        maintain_partitions(conn, retention_months=Config.ARTICLES_RETENTION_MONTHS)
@@ -0,0 +1,118 @@
+# worker/llm_tasks.py
+"""
+LLM work moved off the web process: chat answers on the high-priority "chat" queue,
+image analysis and transcription on "media". The web app only enqueues them, the
+results reach the user through push_message.
+"""
+import base64
+import os
+import tempfile
+import threading
+import traceback
+
+from linebot import LineBotApi # type: ignore
+from linebot.models import TextSendMessage # type: ignore
+
+from config import Config
+from utils.line_messages import error_response, follow_up_messages
+from utils.logger import setup_logger
+from utils.session_store import SessionStore
+from worker.celery_worker import celery
+
+logger = setup_logger()
+
+line_bot_api = LineBotApi(Config.CHANNEL_ACCESS_TOKEN)
+sessions = SessionStore(
+    redis_url=Config.REDIS_URL,
+    maxsize=Config.SESSION_MAX_USERS,
+    ttl=Config.SESSION_TTL,
+    local_ttl=Config.SESSION_LOCAL_TTL,
+)
+
+_msg_response = None
+_msg_response_lock = threading.Lock()
+
+
+def get_message_response():
+    """Process-wide MessageResponse, built on first use so the web app never builds one here."""
+    global _msg_response
+    if _msg_response is None:
+        with _msg_response_lock:
+            if _msg_response is None:
+                from message_response import MessageResponse
+
+                _msg_response = MessageResponse()
+    return _msg_response
+
+
+def push_answer(target, user_id, msg, rephrase):
+    """Answer a message and push the answer and its follow-up questions."""
+    msg_response = get_message_response()
+    try:
+        if Config.STREAM_RESPONSES:
+            chunks, further_future = msg_response.stream_response(
+                user_id=user_id, msg=msg, rephrase=rephrase
+            )
+            for chunk in chunks:
+                line_bot_api.push_message(target, TextSendMessage(text=chunk)) # type: ignore
+            try:
+                questions = further_future.result(timeout=Config.FURTHER_TIMEOUT)
+            except Exception as e:
+                logger.error(f"Follow-up questions failed: {e}")
+                questions = None
+            line_bot_api.push_message(target, follow_up_messages(sessions, user_id, questions))
+            return
+        answer, questions = msg_response.Perplexity_response(
+            user_id=user_id, msg=msg, rephrase=rephrase
+        )
+        messages = [TextSendMessage(text=answer)] + follow_up_messages(sessions, user_id, questions) # type: ignore
+        line_bot_api.push_message(target, messages)
+    except Exception as e:
+        logger.exception(traceback.format_exc())
+        logger.error(e)
+        line_bot_api.push_message(target, TextSendMessage(error_response)) # type: ignore
+
+
+@celery.task(name='worker.llm_tasks.answer_chat')
+def answer_chat(target, user_id, msg, rephrase=True):
+    """Perplexity answer of a chat message, pushed to target (user, group or room)."""
+    push_answer(target, user_id, msg, rephrase)
+
+
+@celery.task(name='worker.llm_tasks.analyze_image')
+def analyze_image(target, user_id, image_base64, additional_info, s3_url=None):
+    """Describe an image with GPT-4o, then answer about what it shows."""
+    msg_response = get_message_response()
+    try:
+        # Stored with the chat turn
+        msg_response.s3_urls[user_id] = s3_url
+        response = msg_response.analyze_image(user_id, image_base64, additional_info)
+    except Exception as e:
+        logger.exception(f"Error processing image with info: {e}")
+        line_bot_api.push_message(target, TextSendMessage(error_response)) # type: ignore
+        return
+    push_answer(
+        target, user_id, f"Provide more information from this object describe:{response}", False
+    )
+
+
+@celery.task(name='worker.llm_tasks.transcribe_audio')
+def transcribe_audio(target, user_id, audio_base64):
+    """Transcribe a voice message with Whisper and answer it on the chat queue."""
+    msg_response = get_message_response()
+    tempfile_path = None
+    try:
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".m4a") as tf:
+            tf.write(base64.b64decode(audio_base64))
+            tempfile_path = tf.name
+        msg = msg_response.transcribe_audio(tempfile_path)
+        if msg.startswith("Error"):
+            raise Exception(msg)
+    except Exception as e:
+        logger.exception(f"Error handling audio message:{e}")
+        line_bot_api.push_message(target, TextSendMessage(text="處理您的音訊訊息時發生錯誤，請稍後再試。")) # type: ignore
+        return
+    finally:
+        if tempfile_path and os.path.exists(tempfile_path):
+            os.remove(tempfile_path)
+    answer_chat.delay(target, user_id, msg, True)
@@ -0,0 +1,55 @@
+"""
+Redis queues of article links, one per crawl run (or per stock), from the search
+spiders to ContentSpider. Records are packed binary instead of JSON:
+
+    website (1 byte) | published (int64 epoch seconds, 0 if unknown)
+    | len(stock_id), len(link), len(title) (uint16 each) | stock_id | link | title
+"""
+import struct
+
+WEBSITES = ("Etoday", "Anue")
+_HEADER = struct.Struct("!BqHHH")
+
+
+def queue_key(name=None):
+    """Queue of one run or stock; without a name the legacy shared queue."""
+    return f"links:{name}" if name else "links"
+
+
+def encode_link(link, stock_id, website, title="", published=0):
+    stock_id, link, title = (str(v).encode("utf-8") for v in (stock_id, link, title or ""))
+    header = _HEADER.pack(WEBSITES.index(website), int(published or 0), len(stock_id), len(link), len(title))
+    return header + stock_id + link + title
+
+
+def decode_link(data):
+    website, published, stock_len, link_len, title_len = _HEADER.unpack_from(data)
+    offset = _HEADER.size
+    fields = []
+    for length in (stock_len, link_len, title_len):
+        fields.append(data[offset:offset + length].decode("utf-8"))
+        offset += length
+    if offset != len(data):
+        raise ValueError(f"Malformed link record of {len(data)} bytes")
+    return {
+        "stock_id": fields[0],
+        "link": fields[1],
+        "title": fields[2],
+        "website": WEBSITES[website],
+        "published": published or None,
+    }
+
+
+def push_links(reclient, key, records, ttl):
+    """Queue the encoded records of one response in one round trip, with one TTL."""
+    if not records:
+        return
+    pipe = reclient.pipeline(transaction=False)
+    pipe.rpush(key, *records)
+    pipe.expire(key, ttl)
+    pipe.execute()
+
+
+def pop_links(reclient, key, count):
+    """Up to count records, oldest first (LPOP with a count needs Redis 6.2)."""
+    return reclient.lpop(key, count) or []
@@ -1,43 +1,150 @@
 from . import settings
+import time
 import psycopg2
+from psycopg2.extras import execute_values
+import redis
+from twisted.internet import task
+from utils.article_cache import bump_article_version
+from utils.seen_urls import SeenUrlFilter
+
+INSERT_ARTICLES = """
+    INSERT INTO articles (stock_id, title, date, url, content)
+    VALUES %s
+    ON CONFLICT DO NOTHING
+    RETURNING url, stock_id
+"""
 
 class PostgresPipeline:
+    """
+    Buffers ContentSpider items and inserts them in multi-row batches.
+    A batch is flushed once it holds POSTGRES_BATCH_SIZE items, when it is older than
+    POSTGRES_FLUSH_INTERVAL seconds, and when the spider closes.
+    """
+
     def __init__(self):
         self.pg_host = settings.DB_HOST
         self.pg_port = 5432
         self.pg_db = settings.DB_NAME
         self.pg_user = settings.DB_USER
         self.pg_password = settings.DB_PASSWORD
+        self.batch_size = settings.POSTGRES_BATCH_SIZE
+        self.flush_interval = settings.POSTGRES_FLUSH_INTERVAL
+        self.buffer = []
+        self.buffer_started = None
+        # After a connection failure, size-triggered flushes wait until then
+        self.retry_at = 0
+        self.conn = None
+        self.cur = None
+        # Used to invalidate the cached article lookups of the web app
+        self.redis_client = redis.StrictRedis(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            db=0,
+        )
+        self.seen_urls = None
+        if settings.SEEN_URLS_ENABLED:
+            self.seen_urls = SeenUrlFilter(
+                self.redis_client, settings.SEEN_URLS_CAPACITY, settings.SEEN_URLS_ERROR_RATE
+            )
 
     def process_item(self, item, spider):
         # Only process items from ContentSpider
         if spider.name != 'content':
             return item
-            
+
+        if not self.buffer:
+            self.buffer_started = time.monotonic()
+        self.buffer.append((
+            item['stock_id'],
+            item['title'],
+            item['date'],
+            item['url'],
+            item['content'],
+        ))
+        if len(self.buffer) >= self.batch_size:
+            self.flush(spider)
+        return item
+
+    def flush_if_due(self, spider):
+        # Runs in a LoopingCall, which stops for good on the first exception
         try:
-            self.cur.execute("""
-                INSERT INTO articles (stock_id, title, date, url, content)
-                VALUES (%s, %s, %s, %s, %s)
-                ON CONFLICT (url) DO NOTHING
-            """, (
-                item['stock_id'],
-                item['title'],
-                item['date'],
-                item['url'],
-                item['content'],
-            ))
+            if self.buffer and time.monotonic() - self.buffer_started >= self.flush_interval:
+                self.flush(spider)
+        except Exception as e:
+            spider.logger.error(f"Periodic flush failed: {e}")
+
+    def flush(self, spider, final=False):
+        """
+        Insert the buffered rows. They stay buffered until they are committed or
+        isolated as bad rows: when the database is unreachable they are retried on a
+        later flush, at most once per flush interval.
+        """
+        rows = self.buffer
+        if not rows or (not final and time.monotonic() < self.retry_at):
+            return
+        start = time.monotonic()
+        try:
+            inserted, failed_urls = self.write(rows, spider)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            spider.logger.error(f"Database unavailable, keeping {len(rows)} articles for the next flush: {e}")
+            self.retry_at = time.monotonic() + self.flush_interval
+            self.close_connection()
+            return
+        self.buffer = []
+
+        failed = len(failed_urls)
+        duplicates = len(rows) - len(inserted) - failed
+        spider.logger.info(
+            f"Flushed {len(rows)} articles in {time.monotonic() - start:.3f}s: "
+            f"{len(inserted)} inserted, {duplicates} duplicates, {failed} failed"
+        )
+        stats = spider.crawler.stats
+        stats.inc_value('postgres/inserted', len(inserted))
+        stats.inc_value('postgres/duplicates', duplicates)
+        stats.inc_value('postgres/failed', failed)
+        if inserted:
+            self.invalidate_cache(spider, *{stock_id for _, stock_id in inserted})
+        if self.seen_urls is not None:
+            # Duplicates are stored too, only failed rows should be fetched again
+            self.seen_urls.add(*(row[3] for row in rows if row[3] not in failed_urls))
+        return inserted
+
+    def write(self, rows, spider):
+        """
+        Insert rows as one batch, falling back to one by one when the batch is refused.
+        Connection errors propagate, nothing is committed for the rows they hit.
+        """
+        if self.conn is None or self.conn.closed:
+            self.connect()
+        try:
+            inserted = execute_values(self.cur, INSERT_ARTICLES, rows, page_size=len(rows), fetch=True)
             self.conn.commit()
-            spider.logger.info(f"Inserted: {item['url']}")
+            return inserted, set()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            raise
         except psycopg2.Error as e:
             self.conn.rollback()
-            spider.logger.error(f"Failed to insert: {item['url']}")
-        return item
+            spider.logger.error(f"Batch insert of {len(rows)} articles failed, retrying one by one: {e}")
+            return self.insert_one_by_one(rows, spider)
 
-    def open_spider(self, spider):
-        # Only open connection for ContentSpider
-        if spider.name != 'content':
-            return
-            
+    def insert_one_by_one(self, rows, spider):
+        """Isolate the bad rows of a failed batch, the others are still inserted."""
+        inserted = []
+        failed_urls = set()
+        for row in rows:
+            try:
+                inserted += execute_values(self.cur, INSERT_ARTICLES, [row], fetch=True)
+                self.conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # Rows committed so far come back as duplicates on the next attempt
+                raise
+            except psycopg2.Error as e:
+                self.conn.rollback()
+                failed_urls.add(row[3])
+                spider.logger.error(f"Failed to insert: {row[3]}: {e}")
+        return inserted, failed_urls
+
+    def connect(self):
         self.conn = psycopg2.connect(
             host=self.pg_host,
             port=self.pg_port,
@@ -45,24 +152,45 @@ class PostgresPipeline:
             user=self.pg_user,
             password=self.pg_password
         )
+        # The articles table is managed by utils/schema.py (python -m utils.schema migrate)
         self.cur = self.conn.cursor()
-        
-        self.cur.execute("""
-            CREATE TABLE IF NOT EXISTS articles (
-                id SERIAL PRIMARY KEY,
-                stock_id INTEGER NOT NULL,
-                title TEXT,
-                date TIMESTAMP,
-                url TEXT UNIQUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                content TEXT
-            )
-        """)
-        self.conn.commit()
+
+    def close_connection(self):
+        # The connection may already be broken, closing it must not raise
+        try:
+            if self.conn is not None:
+                self.conn.close()
+        except psycopg2.Error:
+            pass
+        self.conn = None
+        self.cur = None
+
+    def invalidate_cache(self, spider, *stock_ids):
+        try:
+            bump_article_version(self.redis_client, *stock_ids)
+        except redis.RedisError as e:
+            spider.logger.error(f"Failed to invalidate article cache for {stock_ids}: {e}")
+
+    def open_spider(self, spider):
+        # Only open connection for ContentSpider
+        if spider.name != 'content':
+            return
+            
+        self.connect()
+        # Flush partial batches when items trickle in slowly
+        self.flush_loop = task.LoopingCall(self.flush_if_due, spider)
+        self.flush_loop.start(self.flush_interval, now=False)
 
     def close_spider(self, spider):
         # Only close connection for ContentSpider
         if spider.name != 'content':
             return
-        self.cur.close()
-        self.conn.close()
\ No newline at end of file
+        if self.flush_loop.running:
+            self.flush_loop.stop()
+        self.flush(spider, final=True)
+        if self.buffer:
+            # Counted as failed so the run's high-water marks are not advanced
+            spider.crawler.stats.inc_value('postgres/failed', len(self.buffer))
+            spider.logger.error(f"Lost {len(self.buffer)} articles, the database stayed unavailable")
+            self.buffer = []
+        self.close_connection()
@@ -28,6 +28,19 @@ REDIS_PORT = 6379
 
 SECOND_IN_ONE_MONTH = 30 * 24 * 60 * 60  # 30 days in seconds
 
+# Per-run link queues between the search spiders and ContentSpider
+LINK_QUEUE_TTL = int(os.getenv("LINK_QUEUE_TTL", 24 * 60 * 60))
+LINK_POP_BATCH = int(os.getenv("LINK_POP_BATCH", 100))
+
+# Run the search spiders concurrently while ContentSpider fetches their links,
+# instead of one spider after the other
+PIPELINED_CRAWL = os.getenv("PIPELINED_CRAWL", "true").lower() == "true"
+# Seconds ContentSpider waits for new links when the completion signal is missing
+CONTENT_MAX_IDLE = int(os.getenv("CONTENT_MAX_IDLE", 5 * 60))
+
+# Search spiders page until the last crawl's high-water mark, at most this deep
+SEARCH_MAX_PAGES = int(os.getenv("SEARCH_MAX_PAGES", 10))
+
 # Scheduler settings to use Redis for request queue
 SCHEDULER = "scrapy_redis.scheduler.Scheduler"
 SCHEDULER_PERSIST = True  # Keeps queue between restarts
@@ -40,6 +53,15 @@ ITEM_PIPELINES = {
 }
 
 POSTGRES_PIPELINE_ENABLED = True
+# Articles are inserted in batches of up to POSTGRES_BATCH_SIZE rows, a partial
+# batch is flushed after POSTGRES_FLUSH_INTERVAL seconds
+POSTGRES_BATCH_SIZE = int(os.getenv("POSTGRES_BATCH_SIZE", 100))
+POSTGRES_FLUSH_INTERVAL = float(os.getenv("POSTGRES_FLUSH_INTERVAL", 5))
+
+# Bloom filter of stored article URLs, ContentSpider skips links it already holds
+SEEN_URLS_ENABLED = os.getenv("SEEN_URLS_ENABLED", "true").lower() == "true"
+SEEN_URLS_CAPACITY = int(os.getenv("SEEN_URLS_CAPACITY", 1_000_000))
+SEEN_URLS_ERROR_RATE = float(os.getenv("SEEN_URLS_ERROR_RATE", 0.001))
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 #USER_AGENT = "yahoo_news (+http://www.yourdomain.com)"
 
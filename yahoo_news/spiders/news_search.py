@@ -1,100 +1,239 @@
 import scrapy
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
 from pyquery import PyQuery
 import redis
 import json
+import time
 from datetime import datetime, timezone
 from yahoo_news.items import ContentItem
 from yahoo_news import settings
+from yahoo_news.link_queue import queue_key, encode_link, decode_link, push_links, pop_links
+from utils.seen_urls import SeenUrlFilter
 
 import logging
 logging.info(f"Connecting to Redis at {settings.REDIS_HOST}:{settings.REDIS_PORT}")
 
-class NewsSearchSpider(scrapy.Spider):
+def search_done_key(run_id):
+    return f"crawl:search_done:{run_id}"
+
+
+def mark_search_done(run_id):
+    """Completion signal of a pipelined crawl: no more links will be queued for the run."""
+    reclient = redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=0)
+    reclient.set(search_done_key(run_id), 1, ex=settings.LINK_QUEUE_TTL)
+
+
+def high_water_key(website, stock_id):
+    return f"crawl:high_water:{website}:{stock_id}"
+
+
+def pending_high_water_key(run_id, website, stock_id):
+    return f"crawl:high_water_pending:{run_id}:{website}:{stock_id}"
+
+
+def commit_high_water(run_id, stock_id):
+    """
+    Advance the stock's high-water marks to what the run's search spiders reached.
+    Call it only once the run's ContentSpider has stored the links, or the next run
+    stops at articles that were never stored.
+    """
+    reclient = redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=0)
+    for website in ("Etoday", "Anue"):
+        pending = pending_high_water_key(run_id, website, stock_id)
+        value = reclient.get(pending)
+        if value is None:
+            continue
+        pipe = reclient.pipeline()
+        pipe.set(high_water_key(website, stock_id), value, ex=settings.SECOND_IN_ONE_MONTH)
+        pipe.delete(pending)
+        pipe.execute()
+
+
+class IncrementalSearchMixin:
+    """
+    Search results are newest first, so a search spider walks pages until it reaches
+    what the previous crawl of the stock already recorded (its high-water mark), the
+    results run out, or SEARCH_MAX_PAGES is reached. A finished search only records
+    a pending mark for its run; run_spiders.crawl commits it once ContentSpider stored
+    the links. Without a run id (a spider run by hand) the mark is left alone, and so
+    it is when a page failed: its links, and those of the pages after it, were never
+    queued.
+    """
+    website = None
+    # Set when a result page could not be fetched, parsed or queued
+    incomplete = False
+
+    def page_failed(self, failure):
+        self.incomplete = True
+        self.logger.error(f"Search page of {self.stock_id} failed: {failure.value!r}")
+
+    def load_high_water(self):
+        try:
+            reclient = redis.StrictRedis(connection_pool=self.redis_pool)
+            value = reclient.get(high_water_key(self.website, self.stock_id))
+        except redis.RedisError as e:
+            self.logger.error(f"Failed to read the high-water mark of {self.stock_id}: {e}")
+            return None
+        return value.decode() if value else None
+
+    def closed(self, reason):
+        if reason != "finished" or self.incomplete or self.newest is None or self.run_id is None:
+            if self.incomplete:
+                self.logger.warning(f"Search of {self.stock_id} incomplete, high-water mark kept")
+            return
+        try:
+            reclient = redis.StrictRedis(connection_pool=self.redis_pool)
+            reclient.set(
+                pending_high_water_key(self.run_id, self.website, self.stock_id),
+                self.newest,
+                ex=settings.LINK_QUEUE_TTL,
+            )
+        except redis.RedisError as e:
+            self.logger.error(f"Failed to save the high-water mark of {self.stock_id}: {e}")
+
+
+class NewsSearchSpider(IncrementalSearchMixin, scrapy.Spider):
     name = "news_search"
     start_urls = "https://finance.ettoday.net/search.php7"
+    website = "Etoday"
 
-    def __init__(self, stock_id=None, *args, **kwargs):
+    def __init__(self, stock_id=None, run_id=None, *args, **kwargs):
         super(NewsSearchSpider, self).__init__(*args, **kwargs)
         self.stock_id = stock_id or '2330' 
+        # Links go to the run's own queue, or the stock's when run on its own
+        self.run_id = run_id
+        self.queue = queue_key(run_id or self.stock_id)
         self.redis_pool = redis.ConnectionPool(
             host=settings.REDIS_HOST, 
             port=settings.REDIS_PORT,
             db=0,
             )
+        self.max_pages = settings.SEARCH_MAX_PAGES
+        # The listing has no dates: the mark is the newest link of the last crawl,
+        # and a link that is already stored also ends the walk
+        self.newest = None
+        self.seen_urls = None
+        if settings.SEEN_URLS_ENABLED:
+            self.seen_urls = SeenUrlFilter(
+                redis.StrictRedis(connection_pool=self.redis_pool),
+                settings.SEEN_URLS_CAPACITY,
+                settings.SEEN_URLS_ERROR_RATE,
+            )
     
     def start_requests(self):
-        for page in range(1,3):
-            url = f"{self.start_urls}?keyword={self.stock_id}&page={page}"
-            yield scrapy.Request(
-                url=url,
-                callback=self.parse,
-                meta={'stock_id': self.stock_id, 'page': page}  # Pass metadata for reference in parse
-            )
+        self.high_water = self.load_high_water()
+        yield self.page_request(1)
+
+    def page_request(self, page):
+        url = f"{self.start_urls}?keyword={self.stock_id}&page={page}"
+        return scrapy.Request(
+            url=url,
+            callback=self.parse,
+            errback=self.page_failed,
+            meta={'stock_id': self.stock_id, 'page': page}  # Pass metadata for reference in parse
+        )
 
     def parse(self, response):
+        page = response.meta['page']
         try:
             reclient = redis.StrictRedis(connection_pool=self.redis_pool)
             dom = PyQuery(response.text)
-            dom_list = dom(".part_pictxt_3 a")
-            for item in dom_list.items():
-                link = item.attr("href")
-                if link:
-                    # Store both link and stock_id in Redis
-                    reclient.lpush("links", json.dumps({
-                        "link": link, 
-                        "stock_id": self.stock_id,
-                        "website": "Etoday",
-                    }))
-                    reclient.expire("links", settings.SECOND_IN_ONE_MONTH)
+            links = [item.attr("href") for item in dom(".part_pictxt_3 a").items()]
+            links = [link for link in links if link]
+
+            known = [link == self.high_water for link in links]
+            if self.seen_urls is not None:
+                known = [a or b for a, b in zip(known, self.seen_urls.contains_many(links))]
+            # Everything from the first known link on was recorded by an earlier crawl
+            new_links = links[:known.index(True)] if any(known) else links
+            push_links(
+                reclient,
+                self.queue,
+                [encode_link(link, self.stock_id, "Etoday") for link in new_links],
+                settings.LINK_QUEUE_TTL,
+            )
+            # Only once its links are queued
+            if page == 1 and links:
+                self.newest = links[0]
+
+            if links and not any(known) and page < self.max_pages:
+                yield self.page_request(page + 1)
+            else:
+                self.logger.info(f"Search for {self.stock_id} stopped at page {page}")
         except redis.ConnectionError as e:
+            self.incomplete = True
             self.logger.error(f"Redis Connection Error: {e}")
         except Exception as e:
+            self.incomplete = True
             self.logger.error(f"Unexpected error: {e}")
 
-class AnueSearchSpider(scrapy.Spider):
+class AnueSearchSpider(IncrementalSearchMixin, scrapy.Spider):
     name = "Anue_search"
     starts_url= "https://ess.api.cnyes.com/ess/api/v1/news/keyword"
+    website = "Anue"
+    page_size = 20
 
-    def __init__(self, stock_id=None, *args, **kwargs):
+    def __init__(self, stock_id=None, run_id=None, *args, **kwargs):
         super(AnueSearchSpider, self).__init__(*args, **kwargs)
         self.stock_id = stock_id or '2330' 
+        # Links go to the run's own queue, or the stock's when run on its own
+        self.run_id = run_id
+        self.queue = queue_key(run_id or self.stock_id)
         self.redis_pool = redis.ConnectionPool(
             host=settings.REDIS_HOST, 
             port=settings.REDIS_PORT,
             db=0,
             )
+        self.max_pages = settings.SEARCH_MAX_PAGES
+        # The mark is the newest publish timestamp of the last crawl
+        self.newest = None
 
     def start_requests(self):
-        for page in range(1,2):
-            url = f"{self.starts_url}?q={self.stock_id}&limit=20&page={page}"
-            yield scrapy.Request(
-                url=url,
-                callback=self.parse,
-                meta={'stock_id': self.stock_id, 'page': page}  # Pass metadata for reference in parse
-            )
+        high_water = self.load_high_water()
+        self.high_water = int(high_water) if high_water else 0
+        yield self.page_request(1)
+
+    def page_request(self, page):
+        url = f"{self.starts_url}?q={self.stock_id}&limit={self.page_size}&page={page}"
+        return scrapy.Request(
+            url=url,
+            callback=self.parse,
+            errback=self.page_failed,
+            meta={'stock_id': self.stock_id, 'page': page}  # Pass metadata for reference in parse
+        )
+
     def parse(self, response):
+        page = response.meta['page']
         try:
             reclient = redis.StrictRedis(connection_pool=self.redis_pool)
             item_list = json.loads(response.text)['data']['items']
+            reached_high_water = False
+            records = []
+            newest = self.newest or 0
             for item in item_list:
+                published = int(item["publishAt"])
+                newest = max(newest, published)
+                if published <= self.high_water:
+                    reached_high_water = True
+                    continue
                 id = item["newsId"]
                 title = item["title"]
-                date = datetime.fromtimestamp(int(item["publishAt"]), tz=timezone.utc)
-                date = date.strftime('%Y-%m-%d %H:%M:%S %Z')
                 link = f"https://news.cnyes.com/news/id/{id}"
-                if link:
-                    # Store both link and stock_id in Redis
-                    reclient.lpush("links", json.dumps({
-                        "link": link, 
-                        "stock_id": self.stock_id,
-                        "website": "Anue",
-                        "title": title,
-                        "datetime": date,
-                    }))
-                    reclient.expire("links", settings.SECOND_IN_ONE_MONTH)
+                records.append(encode_link(link, self.stock_id, "Anue", title, published))
+            push_links(reclient, self.queue, records, settings.LINK_QUEUE_TTL)
+            # Only once its links are queued
+            self.newest = newest or None
+
+            if not reached_high_water and len(item_list) >= self.page_size and page < self.max_pages:
+                yield self.page_request(page + 1)
+            else:
+                self.logger.info(f"Search for {self.stock_id} stopped at page {page}")
         except redis.ConnectionError as e:
+            self.incomplete = True
             self.logger.error(f"Redis Connection Error: {e}")
         except Exception as e:
+            self.incomplete = True
             self.logger.error(f"Unexpected error: {e}")
 
 class ContentSpider(scrapy.Spider):
@@ -106,66 +245,115 @@ class ContentSpider(scrapy.Spider):
         # Add other settings if needed
     }
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, run_id=None, stock_id=None, stream=False, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        # Initialize Redis client
+        # Consumes the queue of a run, or of a stock when run on its own
+        self.run_id = run_id
+        self.queue = queue_key(run_id or stock_id)
+        # When streaming the spider keeps waiting for links until the search spiders
+        # of the run are done, instead of closing once the queue is empty
+        self.stream = stream
+        self.last_link_at = time.monotonic()
+        # Initialize Redis client, link records are binary
         self.redis_client = redis.StrictRedis(
             host=settings.REDIS_HOST,
             port=settings.REDIS_PORT,
             db=0,
-            decode_responses=True
         )
         # Initialize logger
         self._logger = logging.getLogger(self.name)
+        self.seen_urls = None
+        if settings.SEEN_URLS_ENABLED:
+            self.seen_urls = SeenUrlFilter(
+                self.redis_client, settings.SEEN_URLS_CAPACITY, settings.SEEN_URLS_ERROR_RATE
+            )
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        return spider
 
     @property
     def logger(self):
         return self._logger
 
+    def spider_idle(self, spider):
+        """Fetch the links queued since the last drain, close only once the run is complete."""
+        if not self.stream:
+            return
+        try:
+            # Read the signal before draining, links queued before it are in this drain
+            done = self.redis_client.exists(search_done_key(self.run_id))
+        except redis.RedisError as e:
+            self._logger.error(f"Failed to read the search completion of {self.run_id}: {e}")
+            done = False
+        requests = list(self.pop_requests())
+        for request in requests:
+            self.crawler.engine.crawl(request)
+        if requests:
+            self.last_link_at = time.monotonic()
+            raise DontCloseSpider
+        # Give up on a run whose completion signal never arrives
+        if not done and time.monotonic() - self.last_link_at < settings.CONTENT_MAX_IDLE:
+            raise DontCloseSpider
+
     def start_requests(self):
         """Fetch URLs from Redis and create requests"""
+        # The seen filter is warmed by the release step (python -m utils.seen_urls warm),
+        # a full scan of articles here would stall every crawl sharing the reactor
+        yield from self.pop_requests()
+
+    def pop_requests(self):
+        """Drain the links currently queued in Redis into requests"""
         try:
-            # Get all links from Redis
             while True:
-                data = self.redis_client.lpop("links")
-                if not data:
+                batch = pop_links(self.redis_client, self.queue, settings.LINK_POP_BATCH)
+                if not batch:
                     self._logger.info("No more items in Redis queue")
                     break
 
-                try:
-                    link_data = json.loads(data)
+                links = []
+                for data in batch:
+                    try:
+                        links.append(decode_link(data))
+                    except (ValueError, IndexError, UnicodeDecodeError) as e:
+                        self._logger.error(f"Failed to decode link record: {e}, Raw data: {data!r}")
+
+                seen = [False] * len(links)
+                if self.seen_urls is not None:
+                    seen = self.seen_urls.contains_many(link_data["link"] for link_data in links)
+                for link_data, stored in zip(links, seen):
                     link = link_data["link"]
-                    stock_id = link_data["stock_id"]
-                    website = link_data["website"]
-
-                    self._logger.info(f"Processing link: {link} for stock_id: {stock_id}, website: {website}")
-
-                    if website == "Etoday":
-                        yield scrapy.Request(
-                            url=link,
-                            callback=self.parse,
-                            meta={"stock_id": stock_id, "website": website}
-                        )
-                    elif website == "Anue":
-                        date = link_data["datetime"]
-                        yield scrapy.Request(
-                            url=link,
-                            callback=self.parse,
-                            meta={"stock_id": stock_id, "website": website, "date": date}
-                        )
-
-                except json.JSONDecodeError as e:
-                    self._logger.error(f"Failed to parse JSON data: {e}, Raw data: {data}")
-                except KeyError as e:
-                    self._logger.error(f"Missing key in Redis data: {e}, Data: {link_data}")
-                except Exception as e:
-                    self._logger.error(f"Unexpected error processing Redis data: {e}")
+                    if stored:
+                        self.crawler.stats.inc_value("seen_urls/skipped")
+                        self._logger.debug(f"Skipping stored link: {link}")
+                        continue
+
+                    self._logger.info(
+                        f"Processing link: {link} for stock_id: {link_data['stock_id']}, website: {link_data['website']}"
+                    )
+                    yield scrapy.Request(
+                        url=link,
+                        callback=self.parse,
+                        errback=self.download_failed,
+                        meta={
+                            "stock_id": link_data["stock_id"],
+                            "website": link_data["website"],
+                            "published": link_data["published"],
+                        }
+                    )
 
         except redis.ConnectionError as e:
             self._logger.error(f"Redis Connection Error: {e}")
         except Exception as e:
             self._logger.error(f"Unexpected error during Redis operation: {e}")
 
+    def download_failed(self, failure):
+        # Counted so the run's high-water marks stay where they were, see run_spiders
+        self.crawler.stats.inc_value("content/download_failed")
+        self._logger.error(f"Failed to fetch {failure.request.url}: {failure.value!r}")
+
     def parse(self, response):
         stock_id = response.meta.get("stock_id")
         item = ContentItem()
@@ -190,10 +378,13 @@ class ContentSpider(scrapy.Spider):
                 content = dom("#article-container").text()
                 item['title'] = dom('article > section').text()
                 item["content"] = content
-                item["date"] = datetime.strptime(response.meta.get("date"), '%Y-%m-%d %H:%M:%S %Z')
+                # Stored as UTC wall time, as before
+                published = datetime.fromtimestamp(response.meta["published"], tz=timezone.utc)
+                item["date"] = published.replace(tzinfo=None)
                 item["url"] = response.url
                 yield item
 
         except Exception as e:
+            self.crawler.stats.inc_value("content/parse_failed")
             self._logger.error(f"Error parsing {response.url}: {e}")
 